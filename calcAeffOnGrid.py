@@ -1,5 +1,7 @@
 import numpy as np
-from omegaH2 import omegaH2 
+import time
+import os
+from omegaH2 import omegaH2, ASTART
 
 ###################################################################################################
 ##
@@ -9,68 +11,452 @@ from omegaH2 import omegaH2
 ##  $ from calcAeffOnGrid import main
 ##  $ main(Ngen=1, BP=1, CASE=4, gMesh=10j, axisRange=[0.5, 8.5, 42, 78])
 ##
+##  Use the exact scaling aeff = h(bsmall)/fpi^2 to fill the grid from a 1D scan in bsmall:
+##  $ main(Ngen=3, BP=1, CASE=4, gMesh=100j, axisRange=[0.5, 8.5, 42, 78], SCALING=True)
+##
+##  Evaluate every grid point with a pool of nProcs worker processes, in chunks of chunkSize points:
+##  $ main(Ngen=3, BP=1, CASE=4, gMesh=100j, axisRange=[0.5, 8.5, 42, 78], nProcs=32, chunkSize=20)
+##
+##  Only evaluate the grid finely where omegaH2 crosses 0.12 or aeff changes steeply, interpolating elsewhere:
+##  $ main(Ngen=3, BP=1, CASE=4, gMesh=100j, axisRange=[0.5, 8.5, 42, 78], ADAPTIVE=True, nProcs=32)
+##
 ###################################################################################################
 
 
-def calcAeffOnGrid(axisRange, gMesh, kwargs, AEFFPATH, CASE=4, COUNTER=10.):
+#-- Convert grid coordinates (x, y) to fpi and bsmall --#
+def gridToParams(x, y, CASE):
+    # x, y may be numbers or arrays
+    if CASE == 0:
+        # x = bsmall_pow, y = fpi_pow
+        fpi    = 10.**y # GeV
+        bsmall = 10.**x
+    elif CASE == 1:
+        # x = mD_pow, y = fpi_pow
+        fpi    = 10.**y # GeV
+        mD     = 10.**x
+        bsmall = mD/(4.*np.pi*fpi)
+    elif CASE == 2:
+        # x = mD GeV, y = fpi GeV
+        fpi    = y # GeV
+        bsmall = x/(4.*np.pi*fpi)
+    elif CASE == 3:
+        # x = mD GeV, y = fpi TeV
+        fpi    = y*1000 # Convert to GeV
+        bsmall = x/(4.*np.pi*fpi)
+    elif CASE ==4:
+        # x = mD TeV, y = fpi TeV
+        mD     = x*1000 # Convert to GeV
+        fpi    = y*1000 # Convert to GeV
+        bsmall = mD/(4.*np.pi*fpi)
+    else:
+        print("Error: Invalid CASE, select either 0,1,2,3, or 4.")
+        return
+    
+    return fpi, bsmall
+
+#-- Grid settings of this worker process, set by initGridWorker --#
+gridWorkerData = {}
+
+#-- Store the settings in each worker, attaching to the precalculated files once per process --#
+def initGridWorker(kwargs, CASE, GHatCacheSize=None):
+    # GHatCacheSize: Number of Ngen=3 G factor sets (~280 MB each) kept by this process, see 
+    #                omegaH2.setGHatFactorsCacheSize. The omegaH2 default (off) is kept if None.
+    if GHatCacheSize is not None:
+        from omegaH2 import setGHatFactorsCacheSize
+        setGHatFactorsCacheSize(GHatCacheSize)
+    kwargs = dict(kwargs)
+    if kwargs['Ngen']==1 and kwargs.get('GHatFactors') is None:
+        from omegaH2 import loadGHatFactors_1gen
+        kwargs['GHatFactors'] = loadGHatFactors_1gen()
+    gridWorkerData['kwargs'] = kwargs
+    gridWorkerData['CASE']   = CASE
+
+#-- Start a pool of nProcs grid workers, or set up this process as the only worker (returns None) --#
+def openGridPool(kwargs, CASE, nProcs=1, GHatCacheSize=1):
+    # The pool can be passed to several calls of calcAeffOnPositions, so the workers keep their caches between them
+    if nProcs > 1:
+        from multiprocessing import Pool
+        return Pool(nProcs, initializer=initGridWorker, initargs=(kwargs, CASE, GHatCacheSize))
+    initGridWorker(kwargs, CASE, GHatCacheSize)
+    return None
+
+#-- Calculate m1 and aeff for a chunk of grid points, indices are passed through to place the results --#
+def calcGridChunk(args):
+    indices, chunk = args
+    kwargs, CASE = gridWorkerData['kwargs'], gridWorkerData['CASE']
+    
+    m1Chunk   = np.zeros(len(chunk))
+    aeffChunk = np.zeros(len(chunk))
+    for k, (x, y) in enumerate(chunk):
+        fpi, bsmall = gridToParams(x, y, CASE)
+        m1, aeff = omegaH2(**dict(kwargs, fpi=fpi, bsmall=bsmall), RETURN='m1_aeff')
+        m1Chunk[k], aeffChunk[k] = m1, aeff.real
+    
+    return indices, m1Chunk, aeffChunk
+
+#-- Calculate omegaH2 from m1, mD and aeff for a chunk of grid points --#
+def calcOmegaH2Chunk(args):
+    indices, m1Chunk, mDChunk, aeffChunk = args
+    from relicDMAbundance import calcOmegaH2
+    aStart = gridWorkerData['kwargs'].get('aStart', ASTART)
+    
+    oh2Chunk = np.zeros(len(indices))
+    for k in range(len(indices)):
+        oh2Chunk[k] = calcOmegaH2(m1Chunk[k], mDChunk[k], aeffChunk[k], aStart=aStart)[0][-1]
+    
+    return indices, oh2Chunk
+
+#-- Calculate m1 and aeff at positions[todo], in chunks of chunkSize points on nProcs processes --#
+def calcAeffOnPositions(positions, kwargs, CASE, nProcs=1, chunkSize=None, COUNTER=10., todo=None, storeChunk=None, 
+                        GHatCacheSize=1, pool=None):
+    """
+    Each worker loads the precalculated files once (and keeps its eigensystem and G factor caches) and evaluates
+    whole chunks of points. Chunks are handed out as workers become free, so uneven costs per point are balanced, 
+    and the results are put back in the order of positions. By default every process gets about 4 chunks.
+    
+    todo:       Indices of the positions to calculate, all by default. Other entries of the results stay zero.
+    storeChunk: Function (indices, m1Chunk, aeffChunk) called as soon as a chunk is finished, e.g. to write it to disk
+    GHatCacheSize: Number of Ngen=3 G factor sets (~280 MB each) cached by each worker (or this process if nProcs=1),
+                   grid points with the same bsmall then share them
+    pool:       Pool from openGridPool to reuse (with nProcs workers), otherwise a pool is started for this call
+    """
+    if todo is None:
+        todo = np.arange(positions.shape[0])
+    imax = len(todo) # Total number of grid points to evaluate
+    if chunkSize is None:
+        chunkSize = max(1, -(-imax//(4*nProcs)))
+    chunks = [(todo[i0:i0+chunkSize], positions[todo[i0:i0+chunkSize]]) for i0 in range(0, imax, chunkSize)]
+    n = max(1, int(len(chunks)/COUNTER)) # Print statement after every n-th chunk
+    print("Calculating %d data points in %d chunks with %d processes"%(imax, len(chunks), nProcs))
+    
+    m1Arr   = np.zeros(positions.shape[0])
+    aeffArr = np.zeros(positions.shape[0])
+    start = time.time()
+    
+    def collect(results):
+        done = 0
+        for i, (indices, m1Chunk, aeffChunk) in enumerate(results):
+            m1Arr[indices], aeffArr[indices] = m1Chunk, aeffChunk
+            if storeChunk is not None:
+                storeChunk(indices, m1Chunk, aeffChunk)
+            done += len(indices)
+            if (i+1) % n == 0 or done == imax:
+                elapsed = time.time() - start
+                print("Calculated %d out of %d data points (%.2f points/s)"%(done, imax, done/elapsed))
+    
+    if pool is not None:
+        collect(pool.imap_unordered(calcGridChunk, chunks))
+    elif nProcs > 1:
+        with openGridPool(kwargs, CASE, nProcs, GHatCacheSize) as pool:
+            collect(pool.imap_unordered(calcGridChunk, chunks))
+    else:
+        openGridPool(kwargs, CASE, 1, GHatCacheSize)
+        collect(map(calcGridChunk, chunks))
+    
+    elapsed = time.time() - start
+    print("Time elapsed: %.1f s, %.3f s per data point and process"%(elapsed, elapsed*nProcs/max(1, imax)))
+    
+    return m1Arr, aeffArr
+
+#-- Open (or create) the partial results of a grid run, [X, Y, m1, aeff] and the mask of finished points --#
+def openGridProgress(AEFFPATH, X, Y, settings):
+    """
+    The partial results are memory mapped from AEFFPATH+".part.npy" (m1 and aeff are NaN until calculated) and 
+    AEFFPATH+".mask.npy" (True for finished points), so a running or crashed grid can be inspected with np.load. 
+    They are reused if AEFFPATH+".part.json" holds the same settings (axisRange, gMesh, CASE, model parameters), 
+    otherwise a new run is started.
+    """
+    import json
+    from numpy.lib.format import open_memmap
+    
+    partFilename, maskFilename, settingsFilename = AEFFPATH+".part.npy", AEFFPATH+".mask.npy", AEFFPATH+".part.json"
+    
+    resume = False
+    if (os.path.exists(partFilename) and os.path.exists(maskFilename) and os.path.exists(settingsFilename)):
+        with open(settingsFilename) as f:
+            resume = (json.load(f) == settings)
+        if not resume:
+            print("Settings of the partial results in %s differ, starting a new grid"%partFilename)
+    
+    if resume:
+        gridResults = open_memmap(partFilename, mode='r+')
+        doneMask    = open_memmap(maskFilename, mode='r+')
+        print("Resuming grid from %s, %d out of %d data points done"%(partFilename, np.sum(doneMask), doneMask.size))
+    else:
+        gridResults = open_memmap(partFilename, mode='w+', dtype=float, shape=(4,)+X.shape)
+        gridResults[0], gridResults[1], gridResults[2:] = X, Y, np.nan
+        doneMask    = open_memmap(maskFilename, mode='w+', dtype=bool, shape=X.shape)
+        gridResults.flush()
+        doneMask.flush()
+        with open(settingsFilename, 'w') as f:
+            json.dump(settings, f)
+    
+    return gridResults, doneMask
+
+#-- Refine a quadtree of grid cells where aeff changes steeply or omegaH2 crosses oh2Target --#
+def calcAeffOnGrid_adaptive(X, positions, kwargs, CASE, nProcs=1, chunkSize=None, COUNTER=10., coarseStep=None, 
+                            oh2Target=0.12, oh2Tol=0.05, aeffTol=0.5, nCheck=10):
+    """
+    Cells are index ranges [i0, i1] x [j0, j1] of the regular grid X (shape (nx, ny)), starting from cells of 
+    coarseStep x coarseStep grid spacings (default: about 8 cells per axis). A cell is split into four at its 
+    midpoint if log(aeff) differs by more than aeffTol between its corners, or else if the omegaH2 values at its 
+    corners reach into [oh2Target(1-oh2Tol), oh2Target(1+oh2Tol)] from both sides or lie in it. Cells of a single 
+    grid spacing are not split further. Each level of new corners is evaluated with calcAeffOnPositions, all levels
+    and the check points share one pool of nProcs workers.
+    
+    m1 only needs the mass spectrum and is calculated exactly on the full grid with omegaH2_batch. omegaH2 (a full
+    Boltzmann solve from kwargs['aStart']) is only calculated at the corners of cells that are not already refined 
+    because of aeff, and is not part of the result. Grid points that were not evaluated get aeff by bilinear 
+    interpolation of log(aeff) inside the smallest cell containing them (smoothness is what left the cell unrefined).
+    The interpolation error is estimated by evaluating nCheck randomly chosen interpolated points, which then keep 
+    their exact values. Returns m1Arr, aeffArr in the order of positions, the mask of evaluated points and the maximal
+    relative error of aeff found at the check points.
+    """
+    nx, ny = X.shape
+    if coarseStep is None:
+        coarseStep = max(1, (max(nx, ny) - 1)//8)
+    
+    #-- m1 on the full grid from the mass spectrum alone --#
+    from omegaH2 import omegaH2_batch
+    fpiArr, bsmallArr = gridToParams(positions[:,0], positions[:,1], CASE)
+    m1Arr = omegaH2_batch(**dict(kwargs, fpi=fpiArr, bsmall=bsmallArr), RETURN='m1')
+    if m1Arr is None:
+        return
+    mDArr = bsmallArr*4.*np.pi*fpiArr
+    
+    aeffArr, oh2Arr = np.zeros(nx*ny), np.zeros(nx*ny)
+    evaluated, oh2Evaluated = np.zeros(nx*ny, dtype=bool), np.zeros(nx*ny, dtype=bool)
+    
+    def flatIndices(nodes, done):
+        if len(nodes) == 0:
+            return np.zeros(0, dtype=int)
+        k = np.unique(np.ravel_multi_index(tuple(np.array(nodes).T), (nx, ny)))
+        return k[~done[k]]
+    
+    def evaluate(nodes, pool):
+        todo = flatIndices(nodes, evaluated)
+        if len(todo) == 0:
+            return
+        _, aeffNew = calcAeffOnPositions(positions, kwargs, CASE, nProcs, chunkSize, COUNTER, todo, pool=pool)
+        aeffArr[todo] = aeffNew[todo]
+        evaluated[todo] = True
+    
+    def evaluateOmegaH2(nodes, pool):
+        todo = flatIndices(nodes, oh2Evaluated)
+        if len(todo) == 0:
+            return
+        size = chunkSize if chunkSize is not None else max(1, -(-len(todo)//(4*nProcs)))
+        chunks = [(todo[i0:i0+size], m1Arr[todo[i0:i0+size]], mDArr[todo[i0:i0+size]], aeffArr[todo[i0:i0+size]]) 
+                  for i0 in range(0, len(todo), size)]
+        start = time.time()
+        for indices, oh2Chunk in (pool.imap_unordered(calcOmegaH2Chunk, chunks) if pool is not None else 
+                                  map(calcOmegaH2Chunk, chunks)):
+            oh2Arr[indices] = oh2Chunk
+        oh2Evaluated[todo] = True
+        print("Calculated omegaH2 at %d data points in %.1f s"%(len(todo), time.time() - start))
+    
+    def corners(cell):
+        i0, i1, j0, j1 = cell
+        return [(i0, j0), (i0, j1), (i1, j0), (i1, j1)]
+    
+    def isMinimal(cell):
+        i0, i1, j0, j1 = cell
+        return i1 - i0 <= 1 and j1 - j0 <= 1
+    
+    def aeffSteep(cell):
+        k = np.ravel_multi_index(tuple(np.array(corners(cell)).T), (nx, ny))
+        logAeff = np.log(np.abs(aeffArr[k]))
+        return np.max(logAeff) - np.min(logAeff) > aeffTol
+    
+    def crossesTarget(cell):
+        k = np.ravel_multi_index(tuple(np.array(corners(cell)).T), (nx, ny))
+        oh2Lo, oh2Hi = oh2Target*(1. - oh2Tol), oh2Target*(1. + oh2Tol)
+        return np.min(oh2Arr[k]) <= oh2Hi and np.max(oh2Arr[k]) >= oh2Lo
+    
+    def split(cell):
+        i0, i1, j0, j1 = cell
+        iSplit = [i0, (i0 + i1)//2, i1] if i1 - i0 > 1 else [i0, i1]
+        jSplit = [j0, (j0 + j1)//2, j1] if j1 - j0 > 1 else [j0, j1]
+        return [(iSplit[a], iSplit[a+1], jSplit[b], jSplit[b+1]) for a in range(len(iSplit)-1) 
+                                                                 for b in range(len(jSplit)-1)]
+    
+    #-- Coarse cells, the last one along each axis may be smaller --#
+    iEdges = list(range(0, nx-1, coarseStep)) + [nx-1]
+    jEdges = list(range(0, ny-1, coarseStep)) + [ny-1]
+    cells  = [(iEdges[a], iEdges[a+1], jEdges[b], jEdges[b+1]) for a in range(len(iEdges)-1) 
+                                                               for b in range(len(jEdges)-1)]
+    
+    pool = openGridPool(kwargs, CASE, nProcs)
+    try:
+        #-- Refine level by level, omegaH2 is only needed where aeff alone does not decide --#
+        leaves = []
+        level  = 0
+        while len(cells) > 0:
+            evaluate([node for cell in cells for node in corners(cell)], pool)
+            steep  = [cell for cell in cells if not isMinimal(cell) and aeffSteep(cell)]
+            smooth = [cell for cell in cells if not isMinimal(cell) and not aeffSteep(cell)]
+            evaluateOmegaH2([node for cell in smooth for node in corners(cell)], pool)
+            refine  = steep + [cell for cell in smooth if crossesTarget(cell)]
+            leaves += [cell for cell in cells if cell not in set(refine)]
+            print("Level %d: %d cells, %d refined, aeff at %d and omegaH2 at %d out of %d grid points"%(level, 
+                  len(cells), len(refine), np.sum(evaluated), np.sum(oh2Evaluated), nx*ny))
+            cells  = [child for cell in refine for child in split(cell)]
+            level += 1
+        
+        #-- Resample aeff onto the regular grid, larger cells first so that finer cells take precedence --#
+        aeffGrid = np.reshape(aeffArr, (nx, ny))
+        evaluatedGrid = np.reshape(evaluated, (nx, ny))
+        for (i0, i1, j0, j1) in sorted(leaves, key=lambda cell: -(cell[1] - cell[0])*(cell[3] - cell[2])):
+            if i1 - i0 <= 1 and j1 - j0 <= 1:
+                continue
+            u = ((np.arange(i0, i1+1) - i0)/(i1 - i0))[:, None]
+            v = ((np.arange(j0, j1+1) - j0)/(j1 - j0))[None, :]
+            fill = ~evaluatedGrid[i0:i1+1, j0:j1+1]
+            c = aeffGrid[[i0, i0, i1, i1], [j0, j1, j0, j1]]
+            LOG = np.all(c > 0)
+            f00, f01, f10, f11 = np.log(c) if LOG else c
+            interp = (1-u)*(1-v)*f00 + (1-u)*v*f01 + u*(1-v)*f10 + u*v*f11
+            aeffGrid[i0:i1+1, j0:j1+1][fill] = (np.exp(interp) if LOG else interp)[fill]
+        
+        #-- Estimate the interpolation error of aeff at randomly chosen interpolated points --#
+        interpolated = np.nonzero(~evaluated)[0]
+        aeffErr = np.nan
+        if nCheck > 0 and len(interpolated) > 0:
+            check = np.sort(np.random.RandomState(0).choice(interpolated, min(nCheck, len(interpolated)), replace=False))
+            _, aeffCheck = calcAeffOnPositions(positions, kwargs, CASE, nProcs, chunkSize, COUNTER, check, pool=pool)
+            relErr  = np.abs(aeffArr[check]/aeffCheck[check] - 1.)
+            aeffErr = np.max(relErr)
+            print("Relative error of the interpolated aeff at %d check points: max %.3e, median %.3e"%(len(check), 
+                                                                                       aeffErr, np.median(relErr)))
+            aeffArr[check]   = aeffCheck[check]
+            evaluated[check] = True
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    return m1Arr, aeffArr, evaluated, aeffErr
+
+def calcAeffOnGrid(axisRange, gMesh, kwargs, AEFFPATH, CASE=4, COUNTER=10., SCALING=False, nBsmall=200, scalingTol=1e-4,
+                   nProcs=1, chunkSize=None, ADAPTIVE=False, coarseStep=None, oh2Target=0.12, oh2Tol=0.05, aeffTol=0.5):
 
     #-- Set up grid --#
     xmin, xmax, ymin, ymax = axisRange[0], axisRange[1], axisRange[2], axisRange[3]
     X, Y = np.mgrid[xmin:xmax:gMesh, ymin:ymax:gMesh] # gMesh x gMesh grid
     positions = np.vstack([X.ravel(), Y.ravel()]).T
     
-    #-- Loop over grid points, store results in a list --#
-    m1List = []
-    aeffList = []
-    
-    i = 0 # Counter for print statements
-    imax = positions.shape[0] # Total number of grid points to evaluate
-    n = int(imax/COUNTER) # Print statement after COUNTER many points calculated
-
-    for x, y in positions:
-
-        if i % n == 0:
-            print("Calculating data point %d out of %d"%(i,imax))
-
-        if CASE == 0:
-            # x = bsmall_pow, y = fpi_pow
-            kwargs["fpi"]    = 10.**y # GeV
-            kwargs["bsmall"] = 10.**x
-        elif CASE == 1:
-            # x = mD_pow, y = fpi_pow
-            kwargs["fpi"]    = 10.**y # GeV
-            mD               = 10.**x
-            kwargs["bsmall"] = mD/(4.*np.pi*kwargs["fpi"])
-        elif CASE == 2:
-            # x = mD GeV, y = fpi GeV
-            kwargs["fpi"]    = y # GeV
-            kwargs["bsmall"] = x/(4.*np.pi*kwargs["fpi"])
-        elif CASE == 3:
-            # x = mD GeV, y = fpi TeV
-            kwargs["fpi"]    = fpi*1000 # Convert to GeV
-            kwargs["bsmall"] = x/(4.*np.pi*kwargs["fpi"])
-        elif CASE ==4:
-            # x = mD TeV, y = fpi TeV
-            mD               = x*1000 # Convert to GeV
-            kwargs["fpi"]    = y*1000 # Convert to GeV
-            kwargs["bsmall"] = mD/(4.*np.pi*kwargs["fpi"])
-        else:
-            print("Error: Invalid CASE, select either 0,1,2,3, or 4.")
+    if gridToParams(xmin, ymin, CASE) is None:
+        return
+    
+    #-- Use m1 = fpi g(bsmall) and aeff = h(bsmall)/fpi^2 instead of evaluating every grid point --#
+    if SCALING:
+        m1Arr, aeffArr = calcAeffOnGrid_scaling(positions, kwargs, CASE, nBsmall, scalingTol)
+        if m1Arr is None:
             return
-
-        m1, aeff = omegaH2(**kwargs, RETURN='m1_aeff')
-
-        m1List.append(m1)
-        aeffList.append(aeff.real)
-
-        i = i+1
+        
+        print("Saving to file at %s"%AEFFPATH)
+        np.save(AEFFPATH, [X, Y, np.reshape(m1Arr, X.shape), np.reshape(aeffArr, X.shape)])
+        return
+    
+    #-- Evaluate the grid finely only around the omegaH2 = oh2Target contour and where aeff is steep --#
+    if ADAPTIVE:
+        result = calcAeffOnGrid_adaptive(X, positions, kwargs, CASE, nProcs, chunkSize, COUNTER, coarseStep, 
+                                         oh2Target, oh2Tol, aeffTol)
+        if result is None:
+            return
+        m1Arr, aeffArr, evaluated, aeffErr = result
+        
+        print("aeff evaluated at %d out of %d grid points, interpolated at the remaining %.1f%% (estimated relative "
+              "error %.1e), m1 exact everywhere"%(np.sum(evaluated), evaluated.size, 100.*np.mean(~evaluated), aeffErr))
+        print("Saving to file at %s"%AEFFPATH)
+        np.save(AEFFPATH, [X, Y, np.reshape(m1Arr, X.shape), np.reshape(aeffArr, X.shape)])
+        return
+    
+    #-- Stream results into the partial results file, skipping points finished by an earlier run --#
+    settings = {'axisRange': [float(a) for a in axisRange], 'gMesh': str(gMesh), 'CASE': CASE, 
+                'kwargs': {k: v for k, v in kwargs.items() if k != 'GHatFactors'}}
+    gridResults, doneMask = openGridProgress(AEFFPATH, X, Y, settings)
+    
+    def storeChunk(indices, m1Chunk, aeffChunk):
+        gridResults[2].ravel()[indices], gridResults[3].ravel()[indices] = m1Chunk, aeffChunk
+        gridResults.flush()
+        # Only marked as done once the values are on disk
+        doneMask.ravel()[indices] = True
+        doneMask.flush()
+    
+    #-- Evaluate the missing grid points --#
+    todo = np.nonzero(~doneMask.ravel())[0]
+    calcAeffOnPositions(positions, kwargs, CASE, nProcs, chunkSize, COUNTER, todo, storeChunk)
     
     #-- Save arrays to files --#
     # X, Y, m1, aeff
     print("Saving to file at %s"%AEFFPATH)
-    np.save(AEFFPATH, [X, Y, np.reshape(np.array(m1List), X.shape ), np.reshape(np.array(aeffList), X.shape )])
+    np.save(AEFFPATH, np.array(gridResults))
+    del gridResults, doneMask # Close the memory maps
+    for filename in [AEFFPATH+".part.npy", AEFFPATH+".mask.npy", AEFFPATH+".part.json"]:
+        os.remove(filename)
+
+#-- Calculate m1/fpi and aeff*fpi^2, which only depend on bsmall (for fixed gs, eQ, sQsq, kappa) --#
+def calcScalingFunctions(kwargs, bsmallArr, fpi):
+    
+    gArr = np.zeros(len(bsmallArr))
+    hArr = np.zeros(len(bsmallArr))
+    for k, bsmall in enumerate(bsmallArr):
+        m1, aeff = omegaH2(**dict(kwargs, fpi=fpi, bsmall=bsmall), RETURN='m1_aeff')
+        gArr[k] = m1/fpi
+        hArr[k] = aeff.real*fpi*fpi
+    
+    return gArr, hArr
 
-def main(Ngen, BP, CASE, gMesh, axisRange):
+#-- Calculate m1 and aeff on the grid from the exact scaling with fpi --#
+def calcAeffOnGrid_scaling(positions, kwargs, CASE, nBsmall=200, scalingTol=1e-4):
+    """
+    With gs, eQ, sQsq and kappa fixed, every pion mass squared is fpi^2 times a function of bsmall, F1const = 4/fpi^2
+    and F2const only depends on bsmall. Hence m1 = fpi g(bsmall) and aeff = h(bsmall)/fpi^2. 
+    
+    The scaling is first checked at the smallest and largest fpi of the grid (the 1e-20 threshold on single
+    reaction cross sections in calcCrossSection breaks it for very large fpi). g and h are then calculated 
+    exactly for each distinct bsmall of the grid if there are at most nBsmall of them (e.g. CASE=0), and 
+    otherwise on nBsmall log-spaced values and interpolated with cubic splines in log(bsmall).
+    """
+    from scipy.interpolate import CubicSpline
+    
+    fpiArr, bsmallArr = gridToParams(positions[:,0], positions[:,1], CASE)
+    fpiMin, fpiMax = np.min(fpiArr), np.max(fpiArr)
+    
+    #-- Check the scaling numerically --#
+    bsmallCheck = np.percentile(bsmallArr, [0., 50., 100.])
+    gMin, hMin = calcScalingFunctions(kwargs, bsmallCheck, fpiMin)
+    gMax, hMax = calcScalingFunctions(kwargs, bsmallCheck, fpiMax)
+    deviation = max(np.max(np.abs(gMax - gMin)/np.abs(gMin)), np.max(np.abs(hMax - hMin)/np.abs(hMin)))
+    print("Maximum relative deviation from fpi scaling: %.3e"%deviation)
+    if deviation > scalingTol:
+        print("Error: m1/fpi or aeff*fpi^2 change by more than scalingTol=%.1e over the grid. Use SCALING=False."%scalingTol)
+        return None, None
+    
+    #-- Calculate g, h as functions of bsmall at a single fpi --#
+    bsmallUnique = np.unique(bsmallArr)
+    if len(bsmallUnique) <= nBsmall:
+        print("Calculating m1 and aeff for %d distinct values of bsmall"%len(bsmallUnique))
+        gArr, hArr = calcScalingFunctions(kwargs, bsmallUnique, fpiMin)
+        indx = np.searchsorted(bsmallUnique, bsmallArr)
+        gGrid, hGrid = gArr[indx], hArr[indx]
+    else:
+        print("Calculating m1 and aeff for %d values of bsmall and interpolating"%nBsmall)
+        bsmallInterp = np.geomspace(bsmallUnique[0], bsmallUnique[-1], nBsmall)
+        gArr, hArr = calcScalingFunctions(kwargs, bsmallInterp, fpiMin)
+        gGrid = CubicSpline(np.log(bsmallInterp), gArr)(np.log(bsmallArr))
+        hGrid = CubicSpline(np.log(bsmallInterp), hArr)(np.log(bsmallArr))
+        
+        #-- Report the interpolation error at points halfway between interpolation nodes --#
+        bsmallMid = np.sqrt(bsmallInterp[:-1]*bsmallInterp[1:])[::max(1, nBsmall//5)]
+        gMid, hMid = calcScalingFunctions(kwargs, bsmallMid, fpiMin)
+        hErr = np.max(np.abs(CubicSpline(np.log(bsmallInterp), hArr)(np.log(bsmallMid)) - hMid)/np.abs(hMid))
+        print("Maximum relative interpolation error of aeff: %.3e"%hErr)
+    
+    return fpiArr*gGrid, hGrid/(fpiArr*fpiArr)
+
+def main(Ngen, BP, CASE, gMesh, axisRange, SCALING=False, nProcs=1, chunkSize=None, ADAPTIVE=False, aStart=ASTART):
     
     if BP == 1:
         kwargs = {'gs':0.8, 'kappa':0.0, 'eQ':0.5, 'sQsq':0.3}
@@ -100,8 +486,17 @@ def main(Ngen, BP, CASE, gMesh, axisRange):
         return
     
     COUNTER = int(gMesh.imag)
+    kwargs['aStart'] = aStart # Start of the Boltzmann solve, only used where omegaH2 is calculated
+    
+    #-- Attach to the memory-mapped G1Hat, ..., G7Hat once instead of looking them up at every grid point --#
+    if Ngen==1:
+        from omegaH2 import loadGHatFactors_1gen
+        kwargs['GHatFactors'] = loadGHatFactors_1gen()
+        if kwargs['GHatFactors'] is None:
+            return
     
-    calcAeffOnGrid(axisRange, gMesh, kwargs, AEFFPATH, CASE, COUNTER)
+    calcAeffOnGrid(axisRange, gMesh, kwargs, AEFFPATH, CASE, COUNTER, SCALING, nProcs=nProcs, chunkSize=chunkSize, 
+                   ADAPTIVE=ADAPTIVE)
     print("Finished successfully!")
     
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+import numpy as np
+import time
+from omegaH2 import omegaH2, ASTART
+from calcAeffOnGrid import gridToParams
+
+###################################################################################################
+##
+##  How to run from command line:
+##
+##
+##  $ from calcOmegaH2Contour import main
+##  $ main(Ngen=1, BP=1, CASE=4, axisRange=[0.5, 8.5, 42, 78])
+##
+##  Traces the omegaH2 = 0.12 curve directly, instead of contouring a dense grid from calcAeffOnGrid.
+##  For each x (mD for CASE=4) the curve is found by root-finding along y (fpi for CASE=4), stepping
+##  along x with a step size controlled by how well the curve is predicted from the previous points.
+##  The curve is followed as a function y(x): where it turns back in x or runs vertically in x the
+##  tracing ends, such branches are not handled.
+##
+###################################################################################################
+
+
+#-- Root-find log(omegaH2(x, y)/oh2Target) along y in [yLo, yHi], widening a bracket around yGuess --#
+def findContourY(calcLogRatio, x, yGuess, width, yLo, yHi, yTol):
+    from scipy.optimize import brentq
+
+    # A guess outside the range (e.g. extrapolated past its edge) is moved onto it, so the bracket stays inside
+    yGuess = min(max(yGuess, yLo), yHi)
+    a, b = max(yLo, yGuess - width), min(yHi, yGuess + width)
+    if not a < b:
+        return None # Empty range or width
+    fa, fb = calcLogRatio(x, a), calcLogRatio(x, b)
+    while fa*fb > 0.:
+        if a == yLo and b == yHi:
+            return None # No crossing in the y range at this x
+        width *= 2.
+        a, b = max(yLo, yGuess - width), min(yHi, yGuess + width)
+        fa, fb = calcLogRatio(x, a), calcLogRatio(x, b)
+
+    y = brentq(lambda y: calcLogRatio(x, y), a, b, xtol=yTol)
+    if not yLo <= y <= yHi:
+        return None # The curve leaves the y range
+    return y
+
+#-- Trace the curve omegaH2 = oh2Target through the region axisRange = [xmin, xmax, ymin, ymax] --#
+def traceOmegaH2Contour(axisRange, kwargs, CASE=4, oh2Target=0.12, yTol=1e-3, predTol=1e-2, hInit=None,
+                        hMin=None, hMax=None):
+    """
+    Returns xArr, yArr, oh2Res, segErr for the ordered polyline (xArr, yArr) along the curve, with x increasing.
+
+    oh2Res: omegaH2/oh2Target - 1 at the vertex, the vertices are accurate to yTol in y
+    segErr: Estimated maximal distance in y between the curve and the straight segment ending at the vertex (0 
+            for the first vertex, NaN for the first segment if there is no third vertex to estimate it from)
+
+    The next vertex is predicted by extrapolating the last segment. The step in x is halved whenever the found
+    vertex misses the prediction by more than predTol*(ymax - ymin) and grows otherwise, so that vertices are
+    dense where the curve bends and sparse where it is straight. Tracing stops at xmax or where the curve leaves
+    the y range. Only x is marched, so tracing also stops where the curve turns back in x or runs vertically, the 
+    rest of such a branch is not followed.
+    """
+    xmin, xmax, ymin, ymax = axisRange
+    yRange = ymax - ymin
+    hInit = (xmax - xmin)/20. if hInit is None else hInit
+    hMin  = (xmax - xmin)/1000. if hMin is None else hMin
+    hMax  = (xmax - xmin)/4. if hMax is None else hMax
+
+    #-- Evaluate omegaH2 once per point, the root-finding revisits bracket ends --#
+    logRatios = {}
+    def calcLogRatio(x, y):
+        if (x, y) not in logRatios:
+            fpi, bsmall = gridToParams(x, y, CASE)
+            oh2, therm = omegaH2(**dict(kwargs, fpi=fpi, bsmall=bsmall))
+            logRatios[(x, y)] = np.log(oh2/oh2Target)
+        return logRatios[(x, y)]
+
+    start = time.time()
+
+    #-- First vertex, searching the full y range --#
+    y = findContourY(calcLogRatio, xmin, 0.5*(ymin + ymax), 0.5*yRange, ymin, ymax, yTol)
+    if y is None:
+        print("Error: omegaH2 does not cross %g at x = %g in the given y range."%(oh2Target, xmin))
+        return
+    xArr, yArr, segErr = [xmin], [y], [0.]
+
+    #-- March along x --#
+    h, slope, width = hInit, 0., 0.1*yRange
+    while xArr[-1] < xmax:
+        xNew  = min(xArr[-1] + h, xmax)
+        yPred = yArr[-1] + slope*(xNew - xArr[-1])
+        yNew  = findContourY(calcLogRatio, xNew, yPred, width, ymin, ymax, yTol)
+
+        if yNew is None:
+            if h > hMin:
+                h = max(hMin, 0.5*h)
+                continue
+            print("Curve leaves the y range after x = %g"%xArr[-1])
+            break
+
+        # No slope is known for the first step, so it is always accepted and its error is estimated below
+        err = abs(yNew - yPred)
+        if err > predTol*yRange and h > hMin and len(xArr) > 1:
+            h = max(hMin, 0.5*h)
+            continue
+
+        # The extrapolation misses a quadratic curve by ~f''h^2, the chord deviates from it by at most f''h^2/8
+        segErr.append(err/8. if len(xArr) > 1 else np.nan)
+        slope = (yNew - yArr[-1])/(xNew - xArr[-1])
+        xArr.append(xNew)
+        yArr.append(yNew)
+
+        width = max(2.*err, 10.*yTol)
+        h = min(hMax, h*min(2., 0.9*np.sqrt(predTol*yRange/max(err, 1e-300))))
+
+    xArr, yArr, segErr = np.array(xArr), np.array(yArr), np.array(segErr)
+    if len(xArr) > 2:
+        # f'' of the parabola through the first three vertices, the first chord deviates from it by f''h^2/8
+        d2y = 2.*((yArr[2] - yArr[1])/(xArr[2] - xArr[1]) - (yArr[1] - yArr[0])/(xArr[1] - xArr[0]))/(xArr[2] - xArr[0])
+        segErr[1] = abs(d2y)*(xArr[1] - xArr[0])**2/8.
+    oh2Res = np.array([np.exp(calcLogRatio(x, y)) - 1. for x, y in zip(xArr, yArr)])
+
+    elapsed = time.time() - start
+    print("Traced %d vertices with %d omegaH2 evaluations in %.1f s"%(len(xArr), len(logRatios), elapsed))
+
+    return xArr, yArr, oh2Res, segErr
+
+def main(Ngen, BP, CASE, axisRange, oh2Target=0.12, yTol=1e-3, predTol=1e-2, aStart=ASTART):
+
+    if BP == 1:
+        kwargs = {'gs':0.8, 'kappa':0.0, 'eQ':0.5, 'sQsq':0.3}
+    elif BP == 2:
+        kwargs = {'gs':0.1, 'kappa':0.0, 'eQ':0.01,'sQsq':0.01}
+    else:
+        print("Error: Invalid BP, must be 1 or 2.")
+        return
+
+    if Ngen not in [1, 3]:
+        print("Error: Invalid Ngen, must be 1 or 3.")
+        return
+    kwargs['Ngen'] = Ngen
+    kwargs['aStart'] = aStart # Start of the Boltzmann solve, see omegaH2.ASTART
+    CONTOURPATH = 'Data/npyFiles/omegaH2Contour_Ngen%d_BP%d.npy'%(Ngen, BP)
+
+    #-- Attach to the memory-mapped G1Hat, ..., G7Hat once instead of looking them up at every point --#
+    if Ngen==1:
+        from omegaH2 import loadGHatFactors_1gen
+        kwargs['GHatFactors'] = loadGHatFactors_1gen()
+        if kwargs['GHatFactors'] is None:
+            return
+
+    result = traceOmegaH2Contour(axisRange, kwargs, CASE, oh2Target, yTol, predTol)
+    if result is None:
+        return
+
+    print("Saving to file at %s"%CONTOURPATH)
+    np.save(CONTOURPATH, np.array(result))
+    print("Finished successfully!")
+
+if __name__ == "__main__":
+
+    main(Ngen=1, BP=1, CASE=4, axisRange=[0.5, 8.5, 42, 78])
@@ -1,7 +1,6 @@
 import numpy as np
 import time
-import os.path
-from os import path
+from collections import OrderedDict
 
 #-- Add utilityFunctions/ to easily use utility .py files --#
 import sys
@@ -10,6 +9,7 @@ sys.path.append("utilityFunctions/")
 #-- Define default settings --#
 DEBUG = False  # Turn off DEBUG statements by default
 TIME  = False  # Turn off printing time statements
+ASTART = 1e-13 # The Boltzmann equation is solved from a = ASTART, see below
 
 ###################################################################################################
 ##
@@ -24,12 +24,161 @@ TIME  = False  # Turn off printing time statements
 ##  $ kwargs = { 'Ngen': 1, 'gs': 0.8, 'eQ': 0.5, 'sQsq': 0.3, 'kappa': 1.0, 'fpi': 60000.0, 'bsmall': 0.006631455962162305}
 ##  $ omegaH2(**kwargs)
 ##
+##  For arrays of parameter points (broadcast against each other), returning arrays of oh2 and therm:
+##  $ from omegaH2 import omegaH2_batch
+##  $ omegaH2_batch(Ngen=1, gs=0.8, eQ=0.5, sQsq=0.3, kappa=1.0, fpi=np.linspace(5e4, 7e4, 10), bsmall=0.0066)
+##
+##  omegaH2 and omegaH2_batch start the Boltzmann solve at a = aStart (default ASTART = 1e-13) from the closed-form
+##  solution of the initial annihilation transient, which takes ~4-7 times fewer solver steps and changes oh2 by ~1e-11
+##  relative (see relicDMAbundance.calcOmegaH2). Pass aStart=0 to integrate the transient numerically.
+##
+##  The .npy files in Data/npyFiles/ are memory mapped (see utilityFunctions/tensorStore.py), so worker processes 
+##  on one node share a single copy.
+##
 ###################################################################################################
 
-def omegaH2(Ngen, gs, fpi, kappa, eQ, bsmall, sQsq, F1HatMatrix=None, F2HatMatrix=None, DEBUG=False, RETURN=None):
+#-- Load G1Hat, ..., G7Hat for Ngen=1, creating the reduced file first if it is missing or out of date --#
+def loadGHatFactors_1gen():
+    
+    from preScan import getPreScanArtifact
+    from tensorStore import openTensor
+    GHatFilename = getPreScanArtifact(1, 'GHat')
+    if GHatFilename is None:
+        return
+    return tuple(openTensor(GHatFilename, Ngen=1))
+
+#-- Expand the trace tensors T and TA stored in TraceFilename to dense tensors --#
+def expandTraceMatrices(TraceFilename):
+    from calcF1F2hat import loadTraceCOO, expandCOO
+    TCOO, TACOO, n = loadTraceCOO(TraceFilename)
+    return expandCOO(TCOO, n), expandCOO(TACOO, n)
+
+#-- Load the trace tensors T and TA for Ngen=3 in the interaction basis, expanded to dense tensors --#
+def loadTraceMatrices_3gen():
+    # The expanded tensors (~1.1 GB) are kept in the artifact cache, so they are only expanded once per process
+    from preScan import getPreScanArtifact
+    from tensorStore import loadArtifact
+    TraceFilename = getPreScanArtifact(3, 'Trace')
+    if TraceFilename is None:
+        return
+    return loadArtifact(TraceFilename, expandTraceMatrices, Ngen=3)
+
+#-- LRU cache of G1Hat, ..., G7Hat in the DM charge basis for Ngen=3 --#
+# These only depend on Wmatrix and hence on (gs, eQ, sQsq, mD/fpi), see calcPionMassSq.eigenSystemKey
+GHatFactorsCache     = OrderedDict()
+GHatFactorsCacheSize = 0 # Each entry holds 7 complex 24x24x66x66 arrays (~280 MB), off unless enabled
+
+#-- Change the number of entries kept in GHatFactorsCache, e.g. 1 in grid workers where bsmall repeats --#
+def setGHatFactorsCacheSize(size):
+    global GHatFactorsCacheSize
+    GHatFactorsCacheSize = size
+    while len(GHatFactorsCache) > size:
+        GHatFactorsCache.popitem(last=False)
+
+#-- Calculate G1Hat, ..., G7Hat in the DM charge basis for Ngen=3 from the mass basis transformation Wmatrix --#
+def calcGHatFactors_3gen(Wmatrix, FMODE='generator', F1HatMatrix=None, F2HatMatrix=None, DEBUG=False):
+    """
+    Wmatrix is Wmatrix_mass of calcPionMassSq_3gen (or one entry of the stack from calcPionMassSq_3gen_batch), 
+    FMODE and the optional Fhat matrices in the interaction basis are as in omegaH2. Returns the 7 factors in the 
+    sector layout read directly by calcSigma_ij, without the F1const, F2const scaling, or None on error.
+    """
+    Ngen = 3
+    BlockedFilename = None
+    
+    #-- Load precalculated matrices if not passed to function --#
+    if (FMODE=='tensor' and (F1HatMatrix is None or F2HatMatrix is None)):
+        # Use the blocked file (only the sector blocks needed are read from it below) or the dense file if they 
+        # have been created with preScan, otherwise the trace tensors
+        from preScan import getPreScanArtifact
+        BlockedFilename = getPreScanArtifact(Ngen, 'FhatBlocked', BUILD=False)
+        FhatFilename    = getPreScanArtifact(Ngen, 'FhatDense', BUILD=False) if BlockedFilename is None else None
+        if FhatFilename is not None:
+            from tensorStore import openTensor
+            F1HatMatrix, F2HatMatrix = openTensor(FhatFilename, Ngen)
+        elif BlockedFilename is None:
+            # Only T and TA are rotated, F1Hat and F2Hat are assembled from them afterwards
+            TraceMatrices = loadTraceMatrices_3gen()
+            if TraceMatrices is None:
+                return
+            TMatrix, TAMatrix = TraceMatrices
+
+    #-- Transform from interaction to mass to DM charge basis in one go --#
+    # Both are a permutation plus 2x2 blocks, so the product is applied with index remaps
+    from transformFs import StructuredTransform
+    from tensorStore import openTensor
+    from preScan import getPreScanArtifact
+    VmatrixFilename = getPreScanArtifact(Ngen, 'Vmatrix')
+    if VmatrixFilename is None:
+        return
+    Vmatrix = openTensor(VmatrixFilename, Ngen)[0]
+    WVmatrix = StructuredTransform.fromDense(Wmatrix) @ StructuredTransform.fromDense(Vmatrix)
+
+    #-- Only the DM DM SM SM blocks read by the cross section are calculated --#
+    from calcF1F2hat import F1HatPatterns, F2HatPatterns
+    from coannihilation import calcDMSMindexlists
+    from crossSection import calcDiagramFactorsSector
+    n, DMindexlist, SMindexlist = calcDMSMindexlists(Ngen)
+
+    if FMODE == 'tensor' and F1HatMatrix is None and BlockedFilename is not None:
+        #-- Rotate the interaction basis blocks D D S S, ... into the DM charge basis blocks --#
+        from tensorStore import readTensorBlock
+        from transformFs import transformFBlock
+        from coannihilation import calcSectorIndexLists
+        intSectors = calcSectorIndexLists(Ngen)
+        DMSectors  = {'D': DMindexlist, 'S': SMindexlist}
+        WVdense    = WVmatrix.toDense()
+        FHatBlocks = {}
+        for (name, patterns) in [('F1', F1HatPatterns), ('F2', F2HatPatterns)]:
+            FHatBlocks[name] = {}
+            for pattern in patterns:
+                FBlock = readTensorBlock(BlockedFilename, name, pattern)
+                if FBlock is None:
+                    return
+                Vblocks = [WVdense[np.ix_(intSectors[l], DMSectors[l])] for l in pattern]
+                FHatBlocks[name][pattern] = transformFBlock(Vblocks, FBlock)
+        F1HatBlocks, F2HatBlocks = FHatBlocks['F1'], FHatBlocks['F2']
+    elif FMODE == 'tensor' and F1HatMatrix is None:
+        #-- Rotate the two base blocks of T and the DDSS block of TA, then permute T into F1Hat --#
+        from transformFs import transformFSector
+        from calcF1F2hat import calcF1HatBlocksFromTraces
+        sectorIndices = {'D': DMindexlist, 'S': SMindexlist}
+        baseTraces  = transformFSector(WVmatrix, TMatrix, ['DDSS', 'DSDS'], sectorIndices, DEBUG)
+        F1HatBlocks = calcF1HatBlocksFromTraces(baseTraces)
+        F2HatBlocks = transformFSector(WVmatrix, TAMatrix, F2HatPatterns, sectorIndices, DEBUG)
+    elif FMODE == 'tensor':
+        from transformFs import transformFSector
+        sectorIndices = {'D': DMindexlist, 'S': SMindexlist}
+        F1HatBlocks = transformFSector(WVmatrix, F1HatMatrix, F1HatPatterns, sectorIndices, DEBUG)
+        F2HatBlocks = transformFSector(WVmatrix, F2HatMatrix, F2HatPatterns, sectorIndices, DEBUG)
+    else:
+        #-- Rotate the generators instead of the Fhat tensors --#
+        from calcMatrices import calcXs, calcA
+        from transformFs import transformXs
+        from calcF1F2hat import calcF1F2HatBlocks
+        X_DMbasis = transformXs(WVmatrix, np.array(calcXs(Ngen, DEBUG=False)), DEBUG)
+        F1HatBlocks, F2HatBlocks = calcF1F2HatBlocks(X_DMbasis, calcA(Ngen, DEBUG=False), 
+                                                     DMindexlist, SMindexlist, DEBUG)
+
+    # G1Hat, ..., G7Hat in the sector layout read directly by calcSigma_ij
+    return calcDiagramFactorsSector(F1HatBlocks, F2HatBlocks)
+
+def omegaH2(Ngen, gs, fpi, kappa, eQ, bsmall, sQsq, F1HatMatrix=None, F2HatMatrix=None, DEBUG=False, RETURN=None, FMODE=None, 
+            GHatFactors=None, CACHE=True, aStart=ASTART):
     
     start_paramScanTime = time.process_time()
     
+    #--------------------------------------#
+    #-- Make sure FMODE flag makes sense --#
+    #--------------------------------------#
+    # Only relevant for Ngen=3, where Fhat matrices must be rotated into the DM charge basis at every point
+    if FMODE is None:
+        FMODE = 'tensor' if (F1HatMatrix is not None and F2HatMatrix is not None) else 'generator'
+    if FMODE not in ['tensor','generator']:
+        print("Error: Invalid FMODE option. Please use one of the following.")
+        print("   'tensor': Rotate the precalculated 91^4 Fhat tensors (requires preScan.py).") 
+        print("'generator': Rotate the 91 generators X and calculate only the Fhat entries needed.")
+        return
+    
     #---------------------------------------#
     #-- Make sure RETURN flag makes sense --#
     #---------------------------------------#
@@ -43,12 +192,10 @@ def omegaH2(Ngen, gs, fpi, kappa, eQ, bsmall, sQsq, F1HatMatrix=None, F2HatMatri
     #---------------------------------------#
     #-- Set overall setings based on Ngen --#
     #---------------------------------------#
+    # The precalculated files are found (and built if missing or out of date) by preScan.getPreScanArtifact
     if(Ngen==1):
-        FhatFilename = "Data/npyFiles/FhatMatrices_DMBasis_Ngen1.npy"
-        nDMPions     = 8  
+        nDMPions        = 8  
     elif(Ngen==3):
-        FhatFilename    = "Data/npyFiles/FhatMatrices_IntBasis_Ngen3.npy"
-        VmatrixFilename = "Data/npyFiles/VMatrix_massToDM_Ngen3.npy"
         nDMPions        = 24
     else:
         print("Error: Invalid Ngen. Please use either Ngen=1 or Ngen=3.")
@@ -80,7 +227,7 @@ def omegaH2(Ngen, gs, fpi, kappa, eQ, bsmall, sQsq, F1HatMatrix=None, F2HatMatri
         M2, _, M2DMarr = calcPionMassSq(Ngen, CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG)
     elif(Ngen==3):
         # M2arr_DMcharge, M2arr_mass, M2DMarr, Wmatrix_mass
-        M2, _, M2DMarr, Wmatrix = calcPionMassSq(Ngen, CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG)
+        M2, _, M2DMarr, Wmatrix = calcPionMassSq(Ngen, CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG, CACHE)
     else:
         print("Error: Invalid Ngen. Please use either Ngen=1 or Ngen=3.")
         return    
@@ -91,27 +238,33 @@ def omegaH2(Ngen, gs, fpi, kappa, eQ, bsmall, sQsq, F1HatMatrix=None, F2HatMatri
     #-----------------------------------------------------------#
     #-- Load precalculated matrices if not passed to function --#
     #-----------------------------------------------------------#
-    if (F1HatMatrix is None) or (F2HatMatrix is None):  
-        if (path.exists(FhatFilename) == False): 
-            print("Error: %s does not exists. Please run preScan.py before proceeding."%FhatFilename)
+    # For Ngen=1 only G1Hat, ..., G7Hat (GHatFactors) are needed unless full Fhat matrices are passed
+    FhatPassed = (F1HatMatrix is not None and F2HatMatrix is not None)
+    
+    # For Ngen=3 reuse G1Hat, ..., G7Hat if this Wmatrix has been seen before (only when Fhat is not passed)
+    GHatCACHE = (CACHE and GHatFactorsCacheSize > 0 and Ngen==3 and not FhatPassed and GHatFactors is None)
+    if GHatCACHE:
+        from calcPionMassSq import eigenSystemKey, cacheGet, cachePut
+        GHatKey = eigenSystemKey(gs, eQ, sQsq, fpi, mD) + (FMODE,)
+        GHatFactors = cacheGet(GHatFactorsCache, GHatKey)
+    
+    if (Ngen==1 and not FhatPassed and GHatFactors is None):
+        GHatFactors = loadGHatFactors_1gen()
+        if GHatFactors is None:
             return
-        else: 
-            F1HatMatrix, F2HatMatrix = np.load(FhatFilename)
     
     #-------------------------------------------#
     #-- Transform Fhat matrices if applicable --#
     #-------------------------------------------#
     if(Ngen==1):
         F1HatMatrix_DMbasis, F2HatMatrix_DMbasis = F1HatMatrix, F2HatMatrix
-    elif(Ngen==3):
-        
-        #-- Transform from interaction to mass to DM charge basis in one go --#
-        Vmatrix = np.load(VmatrixFilename)[0]
-        WVmatrix = Wmatrix @ Vmatrix
+    elif(Ngen==3 and GHatFactors is None):
+        GHatFactors = calcGHatFactors_3gen(Wmatrix, FMODE, F1HatMatrix, F2HatMatrix, DEBUG)
+        if GHatFactors is None:
+            return
         
-        from transformFs import transformF
-        F1HatMatrix_DMbasis = transformF(WVmatrix, F1HatMatrix, DEBUG)
-        F2HatMatrix_DMbasis = transformF(WVmatrix, F2HatMatrix, DEBUG)
+        if GHatCACHE:
+            cachePut(GHatFactorsCache, GHatKey, GHatFactors, GHatFactorsCacheSize)
 
     #---------------------------------------------------------------#
     #-- Calculate F1DMchargeBasisMatrix and F2DMchargeBasisMatrix --#
@@ -120,8 +273,13 @@ def omegaH2(Ngen, gs, fpi, kappa, eQ, bsmall, sQsq, F1HatMatrix=None, F2HatMatri
     F1const = 4./fsq
     F2const = -2.*mD*(lamW*lamW*lamW)/(3*(fsq*fsq))
 
-    F1DMchargeBasisMatrix = F1const*F1HatMatrix_DMbasis
-    F2DMchargeBasisMatrix = F2const*F2HatMatrix_DMbasis
+    if GHatFactors is None:
+        F1DMchargeBasisMatrix = F1const*F1HatMatrix_DMbasis
+        F2DMchargeBasisMatrix = F2const*F2HatMatrix_DMbasis
+        Gfactors = None
+    else:
+        F1DMchargeBasisMatrix, F2DMchargeBasisMatrix = None, None
+        Gfactors = tuple(F1const*G for G in GHatFactors[:6]) + (F2const*GHatFactors[6],)
 
     if (DEBUG):        
         print("Hyperparameter Settings:")
@@ -148,7 +306,7 @@ def omegaH2(Ngen, gs, fpi, kappa, eQ, bsmall, sQsq, F1HatMatrix=None, F2HatMatri
     from coannihilation import calcSigma_ij, calcaEff
 
     # Calculate sigma_ij matrix 
-    sigij = calcSigma_ij(M2, F1DMchargeBasisMatrix, F2DMchargeBasisMatrix, Ngen, aeff=True, DEBUG=DEBUG)
+    sigij = calcSigma_ij(M2, F1DMchargeBasisMatrix, F2DMchargeBasisMatrix, Ngen, aeff=True, DEBUG=DEBUG, Gfactors=Gfactors)
     end   = time.process_time()
 
     if (TIME):
@@ -185,7 +343,7 @@ def omegaH2(Ngen, gs, fpi, kappa, eQ, bsmall, sQsq, F1HatMatrix=None, F2HatMatri
         return m1, aeff
 
     if RETURN == None:
-        omegaH2, therm = calcOmegaH2(m1, mD, np.real(aeff))
+        omegaH2, therm = calcOmegaH2(m1, mD, np.real(aeff), aStart=aStart)
 
         end_paramScanTime = time.process_time()
 
@@ -200,7 +358,160 @@ def omegaH2(Ngen, gs, fpi, kappa, eQ, bsmall, sQsq, F1HatMatrix=None, F2HatMatri
 
         return omegaH2[-1], therm
 
-    
+def omegaH2_batch(Ngen, gs, fpi, kappa, eQ, bsmall, sQsq, DEBUG=False, RETURN=None, GHatFactors=None, chunkSize=256,
+                  FMODE='generator', aStart=ASTART):
+    """
+    Calculates omegaH2 for arrays of parameter points, which are broadcast against each other to N points.
+    Returns arrays of length N: oh2, therm for RETURN=None, m1, aeff for RETURN='m1_aeff' and only m1 for RETURN='m1'
+    (from the mass spectrum alone, without any G factors).
+
+    For Ngen=1 the masses, sigma_ij and aeff of chunkSize points are calculated at once, with the points as a
+    trailing axis. For Ngen=3 the masses of chunkSize points are calculated at once with calcPionMassSq_3gen_batch,
+    and the G factors and sigma_ij are calculated from the Wmatrix of each point (FMODE as in omegaH2, points with 
+    the same mD/fpi are taken in turn and share their G factors), then aeff of the chunk at once. The Boltzmann 
+    equation is solved for each point separately.
+    """
+
+    if RETURN not in [None,'m1_aeff','m1']:
+        print("Error: Invalid RETURN option. Please use one of the following.")
+        print("     None: Will cause omegaH2_batch to return oh2, therm.")
+        print("'m1_aeff': Will cause omegaH2_batch to return m1, aeff.")
+        print("     'm1': Will cause omegaH2_batch to return m1.")
+        return
+
+    if(Ngen==1):
+        nDMPions = 8
+    elif(Ngen==3):
+        nDMPions = 24
+    else:
+        print("Error: Invalid Ngen. Please use either Ngen=1 or Ngen=3.")
+        return
+
+    #-- Define fixed parameters --#
+    garr = np.ones(nDMPions)
+    x    = 20.
+    CA   = -1.
+    CZ   = -1.
+    CG   = -1.
+    CW   =  1.
+
+    #-- Parameters from arguments, one entry per point --#
+    params = np.broadcast_arrays(*[np.atleast_1d(np.asarray(p, dtype=float)) for p in [gs, fpi, kappa, eQ, bsmall, sQsq]])
+    gs, fpi, kappa, eQ, bsmall, sQsq = [np.ravel(p) for p in params]
+    nPoints = len(fpi)
+    lamW = 4.*np.pi*fpi
+    mD   = bsmall*lamW
+
+    #--------------------------#
+    #-- Calculate m1 and aeff --#
+    #--------------------------#
+    start = time.time()
+    m1   = np.zeros(nPoints)
+    aeff = np.zeros(nPoints, dtype=complex)
+
+    if(Ngen==1):
+        from calcPionMassSq import calcPionMassSq_1gen
+        from coannihilation import calcSigma_ij, calcaEff
+        if GHatFactors is None and RETURN != 'm1':
+            GHatFactors = loadGHatFactors_1gen()
+            if GHatFactors is None:
+                return
+
+        for k in range(0, nPoints, chunkSize):
+            chunk = slice(k, k+chunkSize)
+            M2, _, M2DMarr = calcPionMassSq_1gen(CA, CG, CW, CZ, eQ[chunk], gs[chunk], sQsq[chunk], lamW[chunk],
+                                                 fpi[chunk], mD[chunk], kappa[chunk], DEBUG)
+            m1[chunk] = np.sqrt(np.min(M2DMarr, axis=0))
+            if RETURN == 'm1':
+                continue
+
+            fsq  = fpi[chunk]**2
+            F1const = 4./fsq
+            F2const = -2.*mD[chunk]*(lamW[chunk]**3)/(3*(fsq*fsq))
+            Gfactors = tuple(F1const*G[..., None] for G in GHatFactors[:6]) + (F2const*GHatFactors[6][..., None],)
+
+            sigij = calcSigma_ij(M2, None, None, Ngen, aeff=True, DEBUG=DEBUG, Gfactors=Gfactors)
+            aeff[chunk] = calcaEff(sigij, M2DMarr, garr, x, Ngen, DEBUG)
+    else:
+        from calcPionMassSq import calcPionMassSq_3gen_batch, eigenSystemKey, cacheGet, cachePut
+        from coannihilation import calcDMSMindexlists, calcSigma_ij, calcaEff
+        n = calcDMSMindexlists(Ngen)[0]
+
+        # The mass spectrum is calculated for chunkSize points of one benchmark point (gs, eQ, sQsq) at once
+        for benchmark in sorted(set(zip(gs, eQ, sQsq))):
+            indices = np.nonzero((gs == benchmark[0]) & (eQ == benchmark[1]) & (sQsq == benchmark[2]))[0]
+            for k0 in range(0, len(indices), chunkSize):
+                chunk = indices[k0:k0+chunkSize]
+                result = calcPionMassSq_3gen_batch(CA, CG, CW, CZ, benchmark[1], benchmark[0], benchmark[2], 
+                                                   lamW[chunk], fpi[chunk], mD[chunk], kappa[chunk], DEBUG)
+                if result is None:
+                    return
+                M2, _, M2DMarr, Wmatrix = result
+                m1[chunk] = np.sqrt(np.min(M2DMarr, axis=0))
+                if RETURN == 'm1':
+                    continue
+
+                #-- G factors and sigma_ij of each point from its Wmatrix --#
+                # Points are taken in order of their eigensystem key, so those with the same mD/fpi follow each other
+                # and only the last G factors are kept (plus GHatFactorsCache, if enabled)
+                sigij = np.zeros((n, n, len(chunk)), dtype=complex)
+                keys  = [eigenSystemKey(*benchmark, fpi[k], mD[k]) + (FMODE,) for k in chunk]
+                GHatKey = None
+                for m in sorted(range(len(chunk)), key=lambda m: keys[m]):
+                    k = chunk[m]
+                    if keys[m] != GHatKey:
+                        GHatKey = keys[m]
+                        GHatFactors = cacheGet(GHatFactorsCache, GHatKey)
+                        if GHatFactors is None:
+                            GHatFactors = calcGHatFactors_3gen(Wmatrix[m], FMODE, DEBUG=DEBUG)
+                            if GHatFactors is None:
+                                return
+                            if GHatFactorsCacheSize > 0:
+                                cachePut(GHatFactorsCache, GHatKey, GHatFactors, GHatFactorsCacheSize)
+
+                    fsq  = fpi[k]**2
+                    F1const = 4./fsq
+                    F2const = -2.*mD[k]*(lamW[k]**3)/(3*(fsq*fsq))
+                    Gfactors = tuple(F1const*G for G in GHatFactors[:6]) + (F2const*GHatFactors[6],)
+
+                    sigij[..., m] = calcSigma_ij(M2[:, m], None, None, Ngen, aeff=True, DEBUG=DEBUG, Gfactors=Gfactors)
+
+                aeff[chunk] = calcaEff(sigij, M2DMarr, garr, x, Ngen, DEBUG)
+
+    end = time.time()
+    if (TIME):
+        print("------------------------------------------")
+        print("Calculate m1, aeff for %d points"%nPoints)
+        print("Time elapsed: %.3f s, %.1f points/s"%(end - start, nPoints/max(end - start, 1e-12)))
+        print("")
+
+    if RETURN == 'm1':
+        return m1
+    if RETURN == 'm1_aeff':
+        return m1, aeff
+
+    #-----------------------#
+    #-- Calculate omegaH2 --#
+    #-----------------------#
+    from relicDMAbundance import calcOmegaH2
+
+    start = time.time()
+    oh2   = np.zeros(nPoints)
+    therm = np.zeros(nPoints)
+    for k in range(nPoints):
+        omegaH2Arr, therm[k] = calcOmegaH2(m1[k], mD[k], np.real(aeff[k]), aStart=aStart)
+        oh2[k] = omegaH2Arr[-1]
+
+    end = time.time()
+    if (TIME):
+        print("------------------------------------------")
+        print("Calculate omegaH2 for %d points"%nPoints)
+        print("Time elapsed: %.3f s, %.1f points/s"%(end - start, nPoints/max(end - start, 1e-12)))
+        print("")
+
+    return oh2, therm
+
+
 if __name__ == "__main__":
     
     Ngen = int(sys.argv[1])
@@ -1,8 +1,3 @@
-import numpy as np
-import time
-import os.path
-import os
-from os import path
 import ulysses
 
 #-- Add utilityFunctions/ to easily use utility .py files --#
@@ -36,19 +31,17 @@ class SU2LDM(ulysses.ULSBase):
         #---------------------------------#
         #-- Load precalculated matrices --#
         #---------------------------------#
+        # For Ngen=1 only the reduced G1Hat, ..., G7Hat factors of the DM DM -> SM SM reactions are needed.
+        # For Ngen=3 omegaH2 rotates the generators at each point (FMODE='generator'), so the large 
+        # interaction basis Fhat matrices are not needed
+        # Files are memory mapped (tensorStore.openTensor), so all ranks on a node share one copy
+        # Missing or out of date files are built on first use (preScan.getPreScanArtifact), one rank at a time
+        self.F1HatMatrix, self.F2HatMatrix, self.GHatFactors = None, None, None
         if(Ngen==1):
-            FmatFilePath = "Data/npyFiles/FhatMatrices_DMBasis_Ngen1.npy"
-        elif(Ngen==3):
-            FmatFilePath = "Data/npyFiles/FhatMatrices_IntBasis_Ngen3.npy"
-        else:
+            from omegaH2 import loadGHatFactors_1gen
+            self.GHatFactors = loadGHatFactors_1gen() # If None, omegaH2 tries again at every point
+        elif(Ngen!=3):
             print("Error: Invalid Ngen. Please use either Ngen=1 or Ngen=3.")
-            return     
-        
-        if (path.exists(FmatFilePath) == False):
-            print("Error: %s does not exists. Please run preScan.py before proceeding."%FmatFilePath)
-            os.abort()
-        else:
-            self.F1HatMatrix, self.F2HatMatrix = np.load(FmatFilePath)   
 
     def setParams(self, pdict):
         """
@@ -86,6 +79,6 @@ class SU2LDM(ulysses.ULSBase):
         from omegaH2 import omegaH2
         
         oh2, _ = omegaH2(Ngen, gs, fpi, kappa, eQ, bsmall, sQsq, \
-                             self.F1HatMatrix, self.F2HatMatrix, DEBUG)
+                             self.F1HatMatrix, self.F2HatMatrix, DEBUG, GHatFactors=self.GHatFactors)
         
         return oh2
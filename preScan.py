@@ -1,5 +1,6 @@
 import numpy as np
 import time
+import os
 import os.path
 from os import path
 
@@ -20,25 +21,109 @@ PLOT  = False  # Turn off plotting by default
 ##  How to run from command line for Ngen=3:
 ##  $ python preScan.py 3 
 ##
+##  For Ngen=3 only the nonzero entries of the trace tensors tr(X_a X_b X_c X_d) and tr(A X_a X_b X_c X_d) are
+##  stored (TraceTensors_IntBasis_Ngen3.npz), from which F1Hat and F2Hat follow.
+##  Use preScan(Ngen=3, DENSE=True) to also store the full dense matrices (FhatMatrices_IntBasis_Ngen3.npy, 2.2 GB).
+##  These are calculated in shards of slabSize leading indices by nProcs processes, e.g.
+##  $ preScan(Ngen=3, DENSE=True, slabSize=4, nProcs=4)
+##  Completed shards are kept in Data/npyFiles/FhatMatrices_IntBasis_Ngen3.npy.v<version>.part.shards/ until all are done, 
+##  so rerunning the same command after an interruption resumes from them.
+##
+##  Use preScan(Ngen=3, BLOCKED=True) to store F1Hat and F2Hat split into sector blocks 
+##  (FhatMatrices_IntBasis_Ngen3.blk, see utilityFunctions/tensorStore.py), from which omegaH2 only reads the 
+##  blocks mixing into DM DM -> SM SM (~120 MB instead of 2.2 GB). An existing dense file can be converted with
+##  $ convertToBlocked("Data/npyFiles/FhatMatrices_IntBasis_Ngen3.npy", "Data/npyFiles/FhatMatrices_IntBasis_Ngen3.blk",
+##                     calcSectorIndexLists(3))
+##
 #################################
 
-def preScan(Ngen, DEBUG=False):
+#-- Files written by preScan, Ngen -> artifact kind -> filename --#
+preScanArtifacts = {1: {'Fhat':        "Data/npyFiles/FhatMatrices_DMBasis_Ngen1.npy",
+                        'FhatBlocked': "Data/npyFiles/FhatMatrices_DMBasis_Ngen1.blk",
+                        'GHat':        "Data/npyFiles/GHatFactors_DMBasis_Ngen1.npy"},
+                    3: {'Trace':       "Data/npyFiles/TraceTensors_IntBasis_Ngen3.npz",
+                        'Vmatrix':     "Data/npyFiles/VMatrix_massToDM_Ngen3.npy",
+                        'FhatDense':   "Data/npyFiles/FhatMatrices_IntBasis_Ngen3.npy",
+                        'FhatBlocked': "Data/npyFiles/FhatMatrices_IntBasis_Ngen3.blk"}}
+
+#-- Artifacts only written on request (DENSE, BLOCKED) --#
+optionalArtifacts = {1: [], 3: ['FhatDense', 'FhatBlocked']}
+
+#-- Get the filename of a preScan artifact, (re)building it first if it is missing or out of date --#
+def getPreScanArtifact(Ngen, kind, BUILD=True):
+    """
+    kind:  Key of preScanArtifacts[Ngen], e.g. 'GHat' or 'Trace'
+    BUILD: If False, an optional artifact that does not exist is not built (None is returned). Optional artifacts 
+           that exist but are out of date are always rebuilt.
+    
+    Returns None if the artifact is not available, so the caller can fall back or stop.
+    """
+    from tensorStore import ensureArtifact, isArtifactFresh
+    
+    if Ngen not in preScanArtifacts or kind not in preScanArtifacts[Ngen]:
+        print("Error: Unknown preScan artifact %s for Ngen=%s."%(kind, Ngen))
+        return
+    filename = preScanArtifacts[Ngen][kind]
+    if (kind in optionalArtifacts[Ngen] and BUILD == False and path.exists(filename) == False):
+        return
+    
+    def builder():
+        if (kind == 'GHat' and isArtifactFresh(preScanArtifacts[1]['FhatBlocked'], 1, 'FhatBlocked')):
+            preScanGHat_1gen()
+        else:
+            preScan(Ngen, DENSE=(kind=='FhatDense'), BLOCKED=(kind=='FhatBlocked'), OVERWRITE=True)
+    
+    # All artifacts of one Ngen are written by the same preScan call, so they share one lock
+    if ensureArtifact(filename, Ngen, kind, builder, "Data/npyFiles/preScan_Ngen%d.lock"%Ngen):
+        return filename
+    return
+
+#-- Recreate the reduced Ngen=1 file with G1Hat, ..., G7Hat, only reading the DM DM SM SM blocks of Fhat --#
+def preScanGHat_1gen():
+    from tensorStore import readTensorBlocks, saveArray, writeArtifactStamp
+    from calcF1F2hat import F1HatPatterns, F2HatPatterns
+    from crossSection import calcDiagramFactorsSector
+    
+    blockedFilename = preScanArtifacts[1]['FhatBlocked']
+    F1HatBlocks = readTensorBlocks(blockedFilename, 'F1', F1HatPatterns)
+    F2HatBlocks = readTensorBlocks(blockedFilename, 'F2', F2HatPatterns)
+    if F1HatBlocks is None or F2HatBlocks is None:
+        return
+    GHatFactors = tuple(np.ascontiguousarray(G) for G in calcDiagramFactorsSector(F1HatBlocks, F2HatBlocks))
+    saveArray(preScanArtifacts[1]['GHat'], GHatFactors)
+    writeArtifactStamp(preScanArtifacts[1]['GHat'], 1, 'GHat')
+
+def preScan(Ngen, DEBUG=False, DENSE=False, slabSize=1, nProcs=1, BLOCKED=False, OVERWRITE=False):
+    # OVERWRITE: Replace existing files (used by getPreScanArtifact to rebuild out of date files)
 
     #-- Define filename based on Ngen --#
     if(Ngen==1):
-        filename = "Data/npyFiles/FhatMatrices_DMBasis_Ngen1.npy"
+        filename        = preScanArtifacts[1]['Fhat']
+        blockedFilename = preScanArtifacts[1]['FhatBlocked']
     elif(Ngen==3):
-        filename = "Data/npyFiles/FhatMatrices_IntBasis_Ngen3.npy"
+        filename        = preScanArtifacts[3]['Trace']
+        denseFilename   = preScanArtifacts[3]['FhatDense']
+        blockedFilename = preScanArtifacts[3]['FhatBlocked']
     else:
         print("Error: Invalid Ngen. Please use either Ngen=1 or Ngen=3.")
         return         
 
     #-- Check if file already exists --#
-    if(path.exists(filename)): # If matrices have been calculated already, raise error
+    # For Ngen=3 with DENSE or BLOCKED only those files are checked, an up to date trace file is reused
+    OPTIONAL = (Ngen==3 and (DENSE or BLOCKED))
+    if(path.exists(filename) and not OVERWRITE and not OPTIONAL): # If matrices have been calculated already, raise error
         print("Error: %s already exists. Please remove before rerunning preScan.py."%filename)
         return
+    elif(Ngen==3 and DENSE and path.exists(denseFilename) and not OVERWRITE):
+        print("Error: %s already exists. Please remove before rerunning preScan.py."%denseFilename)
+        return
+    elif((Ngen==1 or BLOCKED) and path.exists(blockedFilename) and not OVERWRITE):
+        print("Error: %s already exists. Please remove before rerunning preScan.py."%blockedFilename)
+        return
     else:
         start_preTime = time.process_time()
+        from tensorStore import isArtifactFresh
+        TRACE = (Ngen==3 and not (OPTIONAL and isArtifactFresh(filename, Ngen, 'Trace')))
     
     #------------------------#
     #-- Calculate matrices --#
@@ -62,14 +147,28 @@ def preScan(Ngen, DEBUG=False):
         # Here we only calculate the part which only depends on Ngen (through X and A defs)
         # F1Matrix and F2Matrix with appropriate factors will be calculated later
         start = time.process_time()
-        from calcF1F2hat import calcF1F2HatMatrices
-        F1HatMatrix, F2HatMatrix = calcF1F2HatMatrices(np.array(X), A, Ngen, DEBUG)
+        from calcF1F2hat import calcF1F2HatMatrices, calcF1F2HatMatricesSharded, calcTraceCOO
+        if(Ngen==1):
+            F1HatMatrix, F2HatMatrix = calcF1F2HatMatrices(np.array(X), A, Ngen, DEBUG)
+        elif(DENSE):
+            # Calculate resumable shards in parallel and merge them into a .npy file, which is only moved to 
+            # denseFilename once complete. It is named by the format version, so shards of older versions are never resumed
+            from tensorStore import artifactVersions
+            partFilename = denseFilename+".v%d.part"%artifactVersions['FhatDense']
+            F1HatMatrix, F2HatMatrix = calcF1F2HatMatricesSharded(np.array(X), A, partFilename, slabSize, 
+                                                                  nProcs, DEBUG)
+        if(TRACE):
+            # F1Hat is a combination of permutations of T, F2Hat = TA. Only ~0.2% of the entries are nonzero
+            TCOO, TACOO = calcTraceCOO(np.array(X), A, DEBUG)
+        elif(Ngen==3 and BLOCKED):
+            from calcF1F2hat import loadTraceCOO
+            TCOO, TACOO, _ = loadTraceCOO(filename)
         end   = time.process_time()
         
-        if (DEBUG):
+        if (DEBUG and (Ngen==1 or DENSE)):
             print("------------------------------------------")
-            print("F1HatMatrix Shape: ",F1HatMatrix.shape())
-            print("F2HatMatrix Shape: ",F2HatMatrix.shape())
+            print("F1HatMatrix Shape: ",F1HatMatrix.shape)
+            print("F2HatMatrix Shape: ",F2HatMatrix.shape)
             print("")
         
         if (TIME):
@@ -93,6 +192,7 @@ def preScan(Ngen, DEBUG=False):
         
         print("Transforming F1Hat and F2Hat matrices if applicable, or storing transformation matrices")
         start = time.process_time()
+        storedFilenames = [] # Files written by this run
         if(Ngen==1):
             # Transform to definite DM charge basis
             from convertToDMBasis import calcDMTransformMatrix, convertToDMBasis
@@ -100,7 +200,24 @@ def preScan(Ngen, DEBUG=False):
             F1HatDMchargeBasisMatrix, F2HatDMchargeBasisMatrix = convertToDMBasis(F1HatMatrix, F2HatMatrix, Vmatrix, DEBUG)  
             
             # Save file
-            np.save(filename, [F1HatDMchargeBasisMatrix, F2HatDMchargeBasisMatrix])
+            from tensorStore import saveArray, writeArtifactStamp
+            saveArray(filename, [F1HatDMchargeBasisMatrix, F2HatDMchargeBasisMatrix])
+            writeArtifactStamp(filename, Ngen, 'Fhat')
+            
+            # Also save it split into sector blocks
+            from tensorStore import writeBlockedTensors
+            from coannihilation import calcSectorIndexLists
+            FHatMatrices = {'F1': F1HatDMchargeBasisMatrix, 'F2': F2HatDMchargeBasisMatrix}
+            writeBlockedTensors(blockedFilename, lambda name, indexLists: FHatMatrices[name][np.ix_(*indexLists)], 
+                                ['F1', 'F2'], calcSectorIndexLists(Ngen))
+            writeArtifactStamp(blockedFilename, Ngen, 'FhatBlocked')
+            
+            # Also save the reduced file with only G1Hat, ..., G7Hat for all DM DM -> SM SM reactions
+            from coannihilation import calcSectorDiagramFactors
+            GHatFactors = calcSectorDiagramFactors(F1HatDMchargeBasisMatrix, F2HatDMchargeBasisMatrix, Ngen)
+            saveArray(preScanArtifacts[1]['GHat'], GHatFactors)
+            writeArtifactStamp(preScanArtifacts[1]['GHat'], Ngen, 'GHat')
+            storedFilenames += [filename, blockedFilename, preScanArtifacts[1]['GHat']]
         else:
             # Do not transform, but make sure transformation matrices are calculated and stored
             
@@ -109,11 +226,32 @@ def preScan(Ngen, DEBUG=False):
             # basis transformation. Since the matrix structure doesn't change we can predict the 
             # order of eigenvalues and vectors post diagonalization           
             from convertToDMBasis import calcDMTransformMatrix
-            Vmatrix = calcDMTransformMatrix(Ngen, DEBUG)
-            np.save("Data/npyFiles/VMatrix_massToDM_Ngen3.npy", [Vmatrix])
-            
-            # Save file
-            np.save(filename, [F1HatMatrix, F2HatMatrix])
+            from tensorStore import saveArray, writeArtifactStamp
+            if(TRACE):
+                Vmatrix = calcDMTransformMatrix(Ngen, DEBUG)
+                saveArray(preScanArtifacts[3]['Vmatrix'], [Vmatrix])
+                writeArtifactStamp(preScanArtifacts[3]['Vmatrix'], Ngen, 'Vmatrix')
+                
+                # Save file
+                from calcF1F2hat import saveTraceCOO
+                saveTraceCOO(filename, TCOO, TACOO, len(X))
+                writeArtifactStamp(filename, Ngen, 'Trace')
+                storedFilenames += [preScanArtifacts[3]['Vmatrix'], filename]
+            if(DENSE):
+                del F1HatMatrix, F2HatMatrix # Close the memory maps
+                os.replace(partFilename, denseFilename)
+                writeArtifactStamp(denseFilename, Ngen, 'FhatDense')
+                storedFilenames.append(denseFilename)
+            if(BLOCKED):
+                # Each block is expanded from the COO entries on its own
+                from tensorStore import writeBlockedTensors
+                from calcF1F2hat import calcF1HatCOOFromTrace, expandCOO
+                from coannihilation import calcSectorIndexLists
+                FHatCOO = {'F1': calcF1HatCOOFromTrace(TCOO, len(X)), 'F2': TACOO}
+                writeBlockedTensors(blockedFilename, lambda name, indexLists: expandCOO(FHatCOO[name], len(X), indexLists), 
+                                    ['F1', 'F2'], calcSectorIndexLists(Ngen))
+                writeArtifactStamp(blockedFilename, Ngen, 'FhatBlocked')
+                storedFilenames.append(blockedFilename)
         
         end   = time.process_time()
         end_preTime = time.process_time()
@@ -132,7 +270,7 @@ def preScan(Ngen, DEBUG=False):
             
         print("------------------------------------------")
         print("Prescan finished successfully!")
-        print("Fhat matrices stored in: ", filename)
+        print("Fhat matrices stored in: ", ", ".join(storedFilenames))
 
     
 if __name__ == "__main__":   
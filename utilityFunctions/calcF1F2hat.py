@@ -1,6 +1,8 @@
 import numpy as np
 from scipy.linalg import block_diag
 import itertools
+import os
+from scipy import sparse
 
 #####################################################
 ##
@@ -30,6 +32,44 @@ def F2Hat(a, b, c, d, A, X):
 
     return np.trace(Xtot)
 
+#-- Calculate all products of pairs of generators --#
+def calcPairProducts(X):
+    # P[p,q] = X_p X_q, shape (n, n, dimMat, dimMat)
+    X = np.asarray(X)
+    return np.matmul(X[:, None, :, :], X[None, :, :, :])
+
+#-- Calculate F1 and F2 slabs with a fixed leading index a --#
+def calcF1F2HatSlab(a, P, PT, A):
+    """
+    a:  Leading index of the slab F*Hat[a,:,:,:]
+    P:  Pair products X_p X_q from calcPairProducts, shape (n, n, dimMat, dimMat)
+    PT: Pair products transposed and flattened, PT[(j,i), (p,q)] = (X_p X_q)_ji, shape (dimMat^2, n^2)
+    A:  A matrix from calcA
+    
+    Every trace in F1Hat is a cyclic permutation of S[x,p,q] = tr(X_a X_x X_p X_q) = sum_ij (X_a X_x)_ij (X_p X_q)_ji,
+    so the whole slab follows from a single matrix product over the flattened 14x14 (or 6x6) index pair.
+    """
+    n, dimMat = P.shape[0], P.shape[2]
+    
+    S = (P[a].reshape(n, dimMat*dimMat) @ PT).reshape(n, n, n)
+    
+    # Same traces and the same combination as F1Hat(a, b, c, d, X), indexed [b,c,d]
+    Xtot0 = S.transpose(1, 2, 0) # tr(X_c X_a X_d X_b) = S[d,b,c]
+    Xtot1 = S.transpose(2, 0, 1) # tr(X_a X_c X_d X_b) = S[c,d,b]
+    Xtot2 = S.transpose(0, 2, 1) # tr(X_c X_a X_b X_d) = S[b,d,c]
+    Xtot3 = S.transpose(1, 0, 2) # tr(X_a X_c X_b X_d) = S[c,b,d]
+    Xtot4 = S                    # tr(X_a X_b X_c X_d) = S[b,c,d]
+    
+    term1 = (1./4.)*(Xtot0 + Xtot1)
+    term2 = (-1./12.)*(Xtot2 + Xtot3)
+    term3 = (-1./3.)*(Xtot4)
+    F1HatSlab = term1 + term2 + term3
+    
+    # tr(A X_a X_b X_c X_d) = sum_ij (A X_a X_b)_ij (X_c X_d)_ji
+    F2HatSlab = (np.matmul(A, P[a]).reshape(n, dimMat*dimMat) @ PT).reshape(n, n, n)
+    
+    return F1HatSlab, F2HatSlab
+
 #-- Calculate F1 and F2 Matrices --#
 def calcF1F2HatMatrices(X, A, Ngen=1, DEBUG=True):
             
@@ -44,25 +84,322 @@ def calcF1F2HatMatrices(X, A, Ngen=1, DEBUG=True):
         
     F1HatMatrix = np.zeros((n,n,n,n), dtype=complex)
     F2HatMatrix = np.zeros((n,n,n,n), dtype=complex)
-  
-    dummyarr = np.arange(n) 
     
-    it     = 0
+    #-- Precompute all generator pair products once --#
+    X  = np.asarray(X, dtype=complex)
+    P  = calcPairProducts(X)
+    dimMat = P.shape[2]
+    PT = np.ascontiguousarray(P.transpose(0, 1, 3, 2).reshape(n*n, dimMat*dimMat).T)
+    
+    #-- Fill one slab F*Hat[a,:,:,:] at a time --#
+    # For the Ngen=3 matrices on disk see calcF1F2HatMatricesSharded
     nbatch = n
-    for (a,b,c,d) in itertools.product(dummyarr, dummyarr, dummyarr, dummyarr):
+    for a in range(n):
         
-        if(a == it):
-            it+=1
-            print("Now processing batch %d out of %d"%(it, nbatch))
-        
-        F1HatMatrix[a,b,c,d] = F1Hat(a, b, c, d, X)
-        F2HatMatrix[a,b,c,d] = F2Hat(a, b, c, d, A, X)     
+        print("Now processing batch %d out of %d"%(a+1, nbatch))
         
+        F1HatMatrix[a], F2HatMatrix[a] = calcF1F2HatSlab(a, P, PT, A)
+    
+    if (DEBUG):
+        checkF1F2HatMatrices(F1HatMatrix, F2HatMatrix, X, A)
+
+    return F1HatMatrix, F2HatMatrix
+
+#-- Spot check F1 and F2 Matrices against the explicit trace definitions --#
+def checkF1F2HatMatrices(F1HatMatrix, F2HatMatrix, X, A):
+    n = F1HatMatrix.shape[0]
+    for (a,b,c,d) in itertools.islice(itertools.product(range(n), repeat=4), 0, n**4, max(1, n**4//50)):
+        assert np.isclose(F1HatMatrix[a,b,c,d], F1Hat(a, b, c, d, X), rtol=1e-12, atol=1e-15)
+        assert np.isclose(F2HatMatrix[a,b,c,d], F2Hat(a, b, c, d, A, X), rtol=1e-12, atol=1e-15)
+    print("F1HatMatrix and F2HatMatrix agree with F1Hat and F2Hat on spot checks")
+    print("") 
+
+#-- Pair products, A used by calcShard in each worker process --#
+shardWorkerData = {}
+
+def initShardWorker(X, A):
+    X = np.asarray(X, dtype=complex)
+    P = calcPairProducts(X)
+    n, dimMat = P.shape[0], P.shape[2]
+    shardWorkerData['P']  = P
+    shardWorkerData['PT'] = np.ascontiguousarray(P.transpose(0, 1, 3, 2).reshape(n*n, dimMat*dimMat).T)
+    shardWorkerData['A']  = A
+
+#-- Calculate the slabs a0 <= a < a1 and save them to shardFilename, shape (2, a1-a0, n, n, n) --#
+def calcShard(args):
+    a0, a1, shardFilename = args
+    P, PT, A = shardWorkerData['P'], shardWorkerData['PT'], shardWorkerData['A']
+    
+    F1HatSlabs, F2HatSlabs = zip(*[calcF1F2HatSlab(a, P, PT, A) for a in range(a0, a1)])
+    
+    # Write to a temporary file first, so that a shard file only exists once it is complete
+    with open(shardFilename+".tmp", 'wb') as f:
+        np.save(f, np.array([F1HatSlabs, F2HatSlabs]))
+    os.replace(shardFilename+".tmp", shardFilename)
+    
+    return a0, a1
+
+#-- Calculate F1 and F2 Matrices in parallel, resumable shards --#
+def calcF1F2HatMatricesSharded(X, A, filename, slabSize=1, nProcs=1, DEBUG=True):
+    """
+    Same result as calcF1F2HatMatrices(X, A, Ngen, DEBUG), but stored in the .npy file filename and every batch of 
+    slabSize leading indices (shard) is calculated independently by a pool of nProcs processes and saved to its own checkpoint file 
+    in filename+".shards/". Shards which already exist are skipped, so an interrupted run resumes from the completed 
+    shards. Once all shards exist they are merged into filename and removed. Returns read-only memory maps.
+    """
+    from numpy.lib.format import open_memmap
+    
+    n = len(X)
+    shardDir = filename+".shards"
+    os.makedirs(shardDir, exist_ok=True)
+    
+    shards = []
+    for ibatch in range(-(-n//slabSize)):
+        a0, a1 = ibatch*slabSize, min(n, (ibatch+1)*slabSize)
+        shards.append((a0, a1, os.path.join(shardDir, "shard_%03d_%03d.npy"%(a0, a1))))
+    todo = [shard for shard in shards if not os.path.exists(shard[2])]
+    print("Calculating %d out of %d shards (%d already completed) with %d processes"%(len(todo), len(shards), 
+                                                                                   len(shards) - len(todo), nProcs))
+    
+    #-- Calculate the missing shards --#
+    if nProcs > 1 and len(todo) > 0:
+        from multiprocessing import Pool
+        with Pool(nProcs, initializer=initShardWorker, initargs=(X, A)) as pool:
+            for i, (a0, a1) in enumerate(pool.imap_unordered(calcShard, todo)):
+                print("Finished shard %d out of %d (a = %d, ..., %d)"%(i+1, len(todo), a0, a1-1))
+    elif len(todo) > 0:
+        initShardWorker(X, A)
+        for i, shard in enumerate(todo):
+            a0, a1 = calcShard(shard)
+            print("Finished shard %d out of %d (a = %d, ..., %d)"%(i+1, len(todo), a0, a1-1))
+    
+    #-- Merge the shards into filename, one shard in memory at a time --#
+    print("Merging shards into %s"%filename)
+    FhatMemmap = open_memmap(filename, mode='w+', dtype=complex, shape=(2,n,n,n,n))
+    del FhatMemmap
+    for (a0, a1, shardFilename) in shards:
+        FhatMemmap = open_memmap(filename, mode='r+')
+        FhatMemmap[:, a0:a1] = np.load(shardFilename, mmap_mode='r')
+        FhatMemmap.flush()
+        del FhatMemmap
+    
+    for (a0, a1, shardFilename) in shards:
+        os.remove(shardFilename)
+    os.rmdir(shardDir)
+    
+    F1HatMatrix, F2HatMatrix = np.load(filename, mmap_mode='r')
+    
+    if (DEBUG):
+        checkF1F2HatMatrices(F1HatMatrix, F2HatMatrix, np.asarray(X, dtype=complex), A)
+    
+    return F1HatMatrix, F2HatMatrix
+
+#####################################################
+##
+## Calculate only the F1 and F2 hat blocks needed for 
+## DM DM -> SM SM cross sections
+##
+#####################################################
+
+#-- Index patterns of the blocks read by crossSection.calcDiagramFactors --#
+# Pattern 'SDSD' means F[S[p], D[q], S[r], D[s]] with D (S) the DM (SM) index list
+F1HatPatterns = ['DDSS', 'SDSD', 'SSDD', 'DSDS', 'DSSD', 'SDDS']
+F2HatPatterns = ['DDSS']
+
+#-- Weights of the traces tr(X_{order[0]} ... X_{order[3]}) in F1Hat(a, b, c, d, X) --#
+F1HatTraceWeights = [('cadb', 1./4.), ('acdb', 1./4.), ('cabd', -1./12.), ('acbd', -1./12.), ('abcd', -1./3.)]
+
+#-- Calculate tr(X_i X_j X_k X_l) for i, j, k, l in the index lists I, J, K, L --#
+def calcTraceBlock(X, I, J, K, L, A=None):
+    """
+    If A is given, calculates tr(A X_i X_j X_k X_l) instead.
+    
+    The generators have at most 8 nonzero entries each, so the pair products and the resulting traces are 
+    very sparse. Returns only the nonzero entries as (i, j, k, l) coordinate arrays and values.
+    """
+    dimMat = X.shape[1]
+    
+    left  = np.matmul(X[I][:, None, :, :], X[J][None, :, :, :])
+    right = np.matmul(X[K][:, None, :, :], X[L][None, :, :, :])
+    if A is not None:
+        left = np.matmul(A, left)
+    
+    # tr(left right) = sum_ij left_ij right_ji
+    left  = sparse.csr_matrix(left.reshape(len(I)*len(J), dimMat*dimMat))
+    right = sparse.csr_matrix(right.transpose(0, 1, 3, 2).reshape(len(K)*len(L), dimMat*dimMat))
+    T = (left @ right.T).tocoo()
+    
+    i, j = np.divmod(T.row, len(J))
+    k, l = np.divmod(T.col, len(L))
+    
+    return (i, j, k, l), T.data
+
+#-- Express a trace over a 2 DM + 2 SM block through the two base trace blocks --#
+def traceFromBase(order, pattern, baseTraces):
+    """
+    order:      Order of the block indices inside the trace, e.g. 'cadb' for tr(X_c X_a X_d X_b)
+    pattern:    Sector (D or S) of the block indices a, b, c, d, e.g. 'SDSD'
+    baseTraces: Dictionary with 'DDSS' -> tr(X_i X_j X_c X_d) and 'DSDS' -> tr(X_i X_c X_j X_d), either from 
+                calcTraceBlock as (coords, vals) or as dense blocks
+    
+    Returns the trace in the same form as baseTraces, i.e. the nonzero entries as (a, b, c, d) coordinate arrays 
+    and values, or the dense block indexed [a,b,c,d]. Any trace with two DM and two SM generators is a cyclic 
+    permutation of one of the two base traces.
+    """
+    sector = dict(zip('abcd', pattern))
+    for shift in range(4):
+        rotated = order[shift:] + order[:shift]
+        key = ''.join(sector[i] for i in rotated)
+        if key in baseTraces:
+            axes = [rotated.index(i) for i in 'abcd']
+            if isinstance(baseTraces[key], np.ndarray):
+                return baseTraces[key].transpose(axes)
+            coords, vals = baseTraces[key]
+            return tuple(coords[m] for m in axes), vals
+    
+    print("Error: Trace order %s with pattern %s is not a 2 DM + 2 SM trace."%(order, pattern))
+    return
+
+#-- Calculate the F1 hat blocks from dense base trace blocks --#
+def calcF1HatBlocksFromTraces(baseTraces):
+    # baseTraces: Dictionary with dense 'DDSS' and 'DSDS' trace blocks in any basis, see traceFromBase
+    F1HatBlocks = {}
+    for pattern in F1HatPatterns:
+        F1HatBlocks[pattern] = sum(weight*traceFromBase(order, pattern, baseTraces) 
+                                   for (order, weight) in F1HatTraceWeights)
+    return F1HatBlocks
+
+#-- Calculate the F1 and F2 hat blocks read by the cross section --#
+def calcF1F2HatBlocks(X, A, DMindexlist, SMindexlist, DEBUG=True):
+    """
+    X:           Generators in the basis the blocks are wanted in (e.g. rotated with transformFs.transformXs)
+    A:           A matrix from calcA
+    DMindexlist: Indices of DM charged pions
+    SMindexlist: Indices of SM charged pions
+    
+    Returns dictionaries F1HatBlocks, F2HatBlocks mapping each pattern in F1HatPatterns (F2HatPatterns) to 
+    F*Hat restricted to that block, e.g. F1HatBlocks['SDSD'][p,q,r,s] = F1Hat[S[p], D[q], S[r], D[s]]. 
+    """
+    X = np.asarray(X)
+    sectorIndices = {'D': DMindexlist, 'S': SMindexlist}
+    D, S = DMindexlist, SMindexlist
+    
+    baseTraces = {'DDSS': calcTraceBlock(X, D, D, S, S), 
+                  'DSDS': calcTraceBlock(X, D, S, D, S)}
+    
+    #-- F1Hat: same traces and weights as F1Hat(a, b, c, d, X) --#
+    F1HatBlocks = {}
+    for pattern in F1HatPatterns:
+        F1HatBlock = np.zeros(tuple(len(sectorIndices[i]) for i in pattern), dtype=complex)
+        for (order, weight) in F1HatTraceWeights:
+            coords, vals = traceFromBase(order, pattern, baseTraces)
+            np.add.at(F1HatBlock, coords, weight*vals)
+        F1HatBlocks[pattern] = F1HatBlock
+    
+    #-- F2Hat: A breaks cyclicity, so calculate the block directly --#
+    F2HatBlock = np.zeros((len(D), len(D), len(S), len(S)), dtype=complex)
+    coords, vals = calcTraceBlock(X, D, D, S, S, A=A)
+    F2HatBlock[coords] = vals
+    F2HatBlocks = {'DDSS': F2HatBlock}
+    
+    if (DEBUG):
+        print("Nonzero base traces: ", [baseTraces[key][1].shape[0] for key in baseTraces])
+        print("")
+    
+    return F1HatBlocks, F2HatBlocks
+
+#####################################################
+##
+## Sparse (COO) storage of the F1 and F2 hat matrices
+##
+#####################################################
+
+#-- Sum duplicate entries of a COO tensor and drop exact zeros --#
+def sumDuplicatesCOO(coords, vals, shape):
+    flat = np.ravel_multi_index(coords, shape)
+    flatUnique, inverse = np.unique(flat, return_inverse=True)
+    summed = np.bincount(inverse, weights=vals.real, minlength=len(flatUnique)).astype(vals.dtype)
+    if np.iscomplexobj(vals):
+        summed += 1j*np.bincount(inverse, weights=vals.imag, minlength=len(flatUnique))
+    nonzero = (summed != 0.)
+    return np.unravel_index(flatUnique[nonzero], shape), summed[nonzero]
+
+#-- Calculate the nonzero entries of the trace tensors --#
+def calcTraceCOO(X, A, DEBUG=True):
+    """
+    Returns (Tcoords, Tvals), (TAcoords, TAvals) with T[a,b,c,d] = tr(X_a X_b X_c X_d) and 
+    TA[a,b,c,d] = tr(A X_a X_b X_c X_d) = F2Hat(a, b, c, d, A, X), where coords are four index arrays and all 
+    other entries are zero. F1Hat is a fixed combination of permutations of T (F1HatTraceWeights). A only has 
+    two nonzero (diagonal) entries, so TA is much sparser than T.
+    """
+    X = np.asarray(X, dtype=complex)
+    n = X.shape[0]
+    shape = (n, n, n, n)
+    I = np.arange(n)
     
-    if (DEBUG):#! Make these meaningful later
+    TCOO  = sumDuplicatesCOO(*calcTraceBlock(X, I, I, I, I), shape)
+    TACOO = sumDuplicatesCOO(*calcTraceBlock(X, I, I, I, I, A=A), shape)
+    
+    if (DEBUG):
+        print("Nonzero entries of T, TA: ", len(TCOO[1]), len(TACOO[1]))
         print("")
     
-    if (DEBUG): 
-        print("") 
+    return TCOO, TACOO
+
+#-- Calculate the nonzero entries of F1Hat from those of the trace tensor T --#
+def calcF1HatCOOFromTrace(TCOO, n):
+    traceCoords, traceVals = TCOO
+    F1coords = [[], [], [], []]
+    F1vals   = []
+    for (order, weight) in F1HatTraceWeights:
+        # tr(X_{order[0]} ... X_{order[3]}) = T[i,j,k,l] contributes to F1Hat[a,b,c,d]
+        for m, index in enumerate('abcd'):
+            F1coords[m].append(traceCoords[order.index(index)])
+        F1vals.append(weight*traceVals)
+    
+    return sumDuplicatesCOO(tuple(np.concatenate(c) for c in F1coords), np.concatenate(F1vals), (n, n, n, n))
+
+#-- Save the T and TA COO entries to a .npz file --#
+def saveTraceCOO(filename, TCOO, TACOO, n):
+    # Indices fit in uint8 (n <= 91). Values are stored as real if all imaginary parts are zero
+    arrays = {'n': np.array(n)}
+    for name, (coords, vals) in [('T', TCOO), ('TA', TACOO)]:
+        arrays[name+'coords'] = np.array(coords, dtype=np.uint8)
+        arrays[name+'vals']   = vals.real if not np.any(vals.imag) else vals
+    # Written to a temporary file first, so processes reading the old file are not affected
+    with open(filename+".tmp", 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(filename+".tmp", filename)
 
-    return F1HatMatrix, F2HatMatrix
\ No newline at end of file
+#-- Load the T and TA COO entries, nothing is expanded yet --#
+def loadTraceCOO(filename):
+    with np.load(filename) as data:
+        n = int(data['n'])
+        TCOO  = (tuple(data['Tcoords'].astype(np.intp)), data['Tvals'])
+        TACOO = (tuple(data['TAcoords'].astype(np.intp)), data['TAvals'])
+    return TCOO, TACOO, n
+
+#-- Expand COO entries to a dense tensor, optionally only for the block I x J x K x L --#
+def expandCOO(COO, n, indexLists=None):
+    """
+    COO:        (coords, vals) as returned by calcTraceCOO, loadTraceCOO or calcF1HatCOOFromTrace
+    indexLists: None for the full (n,n,n,n) tensor, or four index lists [I, J, K, L] to only expand
+                F[np.ix_(I, J, K, L)]
+    """
+    coords, vals = COO
+    if indexLists is None:
+        indexLists = [np.arange(n)]*4
+    
+    # Position of every old index inside each index list (-1 if not in the block)
+    positions = []
+    keep = np.ones(len(vals), dtype=bool)
+    for m, indices in enumerate(indexLists):
+        lookup = -np.ones(n, dtype=np.intp)
+        lookup[np.asarray(indices)] = np.arange(len(indices))
+        positions.append(lookup[coords[m]])
+        keep &= (positions[m] >= 0)
+    
+    F = np.zeros(tuple(len(indices) for indices in indexLists), dtype=np.result_type(vals, float))
+    F[tuple(p[keep] for p in positions)] = vals[keep]
+    
+    return F
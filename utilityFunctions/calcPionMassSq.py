@@ -1,5 +1,6 @@
 import numpy as np
 from numpy import linalg as LA
+from collections import OrderedDict
 
 #################################################################
 ##
@@ -9,6 +10,8 @@ from numpy import linalg as LA
 
 def calcPionMassSq_1gen(CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG=True):
     """
+    The parameters may also be broadcastable arrays, in which case the returned mass arrays carry the broadcast 
+    shape as trailing axes, e.g. M2arr_DMcharge of shape (15, N) for N parameter points.
     """    
     fsq  = fpi**2 
     pi3  = np.pi**3
@@ -29,8 +32,8 @@ def calcPionMassSq_1gen(CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBU
                     (CZ*eQsq*fsq)/(18.*sQsq) - (CZ*eQsq*fsq*sQsq)/2.
     Msq14    =  64.*fpi*mD*pi3
 
-    M2arr_mass = np.array([Msq0, Msq1to4, Msq1to4, Msq1to4, Msq1to4, Msq5and8, Msq6and7, \
-                   Msq6and7, Msq5and8, Msq9to12, Msq9to12, Msq9to12, Msq9to12, 0., Msq14]) # Mass Squared Array in mass basis
+    M2arr_mass = np.array(np.broadcast_arrays(Msq0, Msq1to4, Msq1to4, Msq1to4, Msq1to4, Msq5and8, Msq6and7, \
+                   Msq6and7, Msq5and8, Msq9to12, Msq9to12, Msq9to12, Msq9to12, 0., Msq14)) # Mass Squared Array in mass basis
     
     #-- Convert to mass array in DM charge basis --#
     #  8 ->  6,  6 ->  7,  7 ->  8
@@ -97,65 +100,174 @@ def calcUniqueVals(CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG=Tru
 
     return np.array([uV1, uV2, uV3, uV4, uV5, uV6, uV7, uV8, uV9, uV10, uV11, uV12])
 
-def calcPionMassSq_3gen(CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG=True):
+#################################################################
+##
+## Cache of the Ngen=3 eigensystem
+##
+#################################################################
+
+# Every unique value of M2_nondiag is fpi^2*alpha + fpi*mD*beta, so M2_nondiag/fpi^2 only depends on mD/fpi 
+# (i.e. on bsmall) for a given benchmark point. The eigenvectors are therefore reused for all fpi and only the 
+# eigenvalues are rescaled by fpi^2.
+eigenSystemCache     = OrderedDict()
+eigenSystemCacheSize = 128 # Each entry holds a 91x91 matrix (~65 kB)
+
+def eigenSystemKey(gs, eQ, sQsq, fpi, mD):
+    # mD/fpi is rounded so that the same bsmall at different fpi gives the same key
+    return (gs, eQ, sQsq, float('%.12e'%(mD/fpi)))
+
+def cacheGet(cache, key):
+    # Returns None if key is not in the LRU cache
+    if key not in cache:
+        return
+    cache.move_to_end(key)
+    return cache[key]
+
+def cachePut(cache, key, value, maxsize):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > maxsize:
+        cache.popitem(last=False)
+
+def clearEigenSystemCache():
+    eigenSystemCache.clear()
+
+#################################################################
+##
+## Block diagonalization of the Ngen=3 mass matrix
+##
+#################################################################
+
+# Indices of non-zero values of M2_nondiag for Ngen=3
+# There are 12 unique values
+# g[i] contains list of these index pairs in Mathematica notation (1 to 91)
+# Ex. g[0] -> [[1,1]] -> M2_nondiag[0,0] = uV1
+gIndex_3gen = [[[1, 1]], 
+              [[1, 91], [91, 1]], 
+              [[2, 2], [3, 3], [4, 4], [5, 5], [46, 46], [47, 47], [48, 48], [49, 49], [74, 74], [75, 75], [76, 76], [77, 77]], 
+              [[7, 7], [8, 8], [15, 15], [16, 16], [51, 51], [52, 52]], 
+              [[10, 10], [11, 11], [12, 12], [13, 13], [18, 18], [19, 19], [20, 20], [21, 21], [26, 26], [27, 27], [28, 28], 
+               [29, 29],[34, 34], [35, 35], [36, 36], [37, 37], [54, 54], [55, 55], [56, 56], [57, 57], [62, 62], [63, 63], 
+               [64, 64], [65, 65]], 
+              [[10, 26], [18, 34], [26, 10], [34, 18], [54, 62], [62, 54]], 
+              [[11, 27], [12, 28], [13, 29], [19, 35], [20, 36], [21, 37], [27, 11], [28, 12], [29, 13], [35, 19], [36, 20], 
+               [37, 21], [55, 63], [56, 64], [57, 65], [63, 55], [64, 56], [65, 57]], 
+              [[22, 22], [25, 25], [58, 58], [61, 61], [78, 78], [81, 81]], 
+              [[23, 23], [24, 24], [59, 59], [60, 60], [79, 79], [80, 80]], 
+              [[31, 31], [32, 32], [33, 33], [39, 39], [40, 40], [41, 41], [67, 67], [68, 68], [69, 69]], 
+              [[42, 42], [43, 43], [44, 44], [45, 45], [70, 70], [71, 71], [72, 72], [73, 73], [82, 82], [83, 83], [84, 84], 
+               [85, 85]], 
+              [[91, 91]]]
+
+# First index (0 to 90) of each 2x2 block of M2_nondiag in the order used for the mass basis, i.e. for columns 
+# 0-25 of Wmatrix_mass. The remaining 1x1 blocks follow in increasing order (columns 26-90). This is the order 
+# assumed by indxArr below and by Data/npyFiles/VMatrix_massToDM_Ngen3.npy
+massBasisPairOrder = [0, 11, 10, 53, 17, 54, 12, 19, 55, 18, 20, 56, 9]
+
+massMatrixBlocks = None # (pairIndx, singleIndx) found once by calcMassMatrixBlocks
+
+def calcMassMatrixBlocks(gIndex, n=91):
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    
+    #-- Find connected blocks from the non-zero entries --#
+    arr = np.concatenate([np.array(g) for g in gIndex]) - 1
+    nBlocks, labels = connected_components(coo_matrix((np.ones(arr.shape[0]), (arr[:,0], arr[:,1])), shape=(n,n)), 
+                                           directed=False)
+    blocks = [np.nonzero(labels == l)[0] for l in range(nBlocks)]
+    
+    # All blocks are 1x1 or 2x2, which are diagonalized in closed form
+    pairBlocks   = {blk[0]: blk for blk in blocks if len(blk) == 2}
+    singleBlocks = [blk[0] for blk in blocks if len(blk) == 1]
+    assert len(pairBlocks) + len(singleBlocks) == nBlocks
+    assert sorted(pairBlocks.keys()) == sorted(massBasisPairOrder)
+    
+    pairIndx   = np.array([pairBlocks[i] for i in massBasisPairOrder]) # Shape (nPairs, 2)
+    singleIndx = np.array(singleBlocks)
+    
+    return pairIndx, singleIndx
+
+def diagonalizeMassMatrix(M2_nondiag, pairIndx, singleIndx):
+    # M2_nondiag may also be a stack of shape (N, n, n), giving M2arr_mass of shape (N, n) and Wmatrix_mass of 
+    # shape (N, n, n)
     
-    #-- Define empty non-diagonal M2 matrix --#
-    M2_nondiag = np.zeros((91,91), dtype=complex)
+    n      = M2_nondiag.shape[-1]
+    nPairs = pairIndx.shape[0]
+    batchShape = M2_nondiag.shape[:-2]
     
-    #-- Get array of unique values --#
+    M2arr_mass   = np.zeros(batchShape + (n,))
+    Wmatrix_mass = np.zeros(batchShape + (n,n))
+    
+    #-- 2x2 blocks [[a, b], [b, c]] --#
+    # Rotation by theta in (-pi/4, pi/4], so the first eigenvector (cos, sin) is the one connected to index i
+    i, j = pairIndx[:,0], pairIndx[:,1]
+    a, b, c = M2_nondiag[...,i,i], M2_nondiag[...,i,j], M2_nondiag[...,j,j]
+    theta = np.where(a == c, np.copysign(np.pi/4., b), 0.5*np.arctan(2.*b/np.where(a == c, 1., a - c)))
+    cos, sin = np.cos(theta), np.sin(theta)
+    
+    col1 = 2*np.arange(nPairs)
+    col2 = col1 + 1
+    M2arr_mass[...,col1] = a*cos*cos + 2.*b*cos*sin + c*sin*sin
+    M2arr_mass[...,col2] = a*sin*sin - 2.*b*cos*sin + c*cos*cos
+    Wmatrix_mass[...,i,col1], Wmatrix_mass[...,j,col1] =  cos, sin
+    Wmatrix_mass[...,i,col2], Wmatrix_mass[...,j,col2] = -sin, cos
+    
+    #-- 1x1 blocks --#
+    colS = 2*nPairs + np.arange(singleIndx.shape[0])
+    M2arr_mass[...,colS] = M2_nondiag[...,singleIndx,singleIndx]
+    Wmatrix_mass[...,singleIndx,colS] = 1.
+    
+    return M2arr_mass, Wmatrix_mass
+
+#-- Convert M2arr_mass to M2arr_DMcharge --#
+# New index: 0,  1, ..., 89, 90 <- np.arange(91)
+# Old index: 0, 38, ..., 90,  1 <- indxArr_3gen
+# Note: The mass basis order is fixed by massBasisPairOrder in diagonalizeMassMatrix
+indxArr_3gen = np.concatenate((np.array([0,  38,41,39,40,  50,53,51,52,  62,65,63,64,  70,73,71,72,  78,81,79,80,  82,85,83,84]),
+                               np.arange(35+1)+2, np.arange(7+1)+42, np.arange(7+1)+54, np.arange(3+1)+66, 
+                               np.arange(3+1)+74, np.arange(4+1)+86, np.array([1])))
+
+#-- Place the unique values at their locations in M2_nondiag --#
+def calcMassMatrix_3gen(uVs):
+    # uVs of shape (12,) or (12, N) give M2_nondiag of shape (91, 91) or (N, 91, 91)
+    M2_nondiag = np.zeros(np.shape(uVs)[1:] + (91,91))
+    for i in range(len(uVs)):
+        arr = np.array(gIndex_3gen[i])
+        M2_nondiag[..., arr[:,0]-1, arr[:,1]-1] = np.asarray(uVs[i])[..., None]
+    
+    return M2_nondiag
+
+def calcPionMassSq_3gen(CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG=True, CACHE=True):
+    
+    #-- Reuse the eigensystem if this benchmark point and mD/fpi have been diagonalized before --#
+    if CACHE:
+        key = eigenSystemKey(gs, eQ, sQsq, fpi, mD)
+        cached = cacheGet(eigenSystemCache, key)
+        if cached is not None:
+            M2arrHat_mass, Wmatrix_mass, indxArr = cached
+            M2arr_mass = (fpi*fpi)*M2arrHat_mass
+            M2arr_DMcharge = M2arr_mass[indxArr]
+            return M2arr_DMcharge, M2arr_mass, M2arr_DMcharge[np.arange(24)+1], Wmatrix_mass
+    
+    #-- Get array of unique values and assign them to their locations in M2_nondiag --#
     uVs = calcUniqueVals(CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG)
+    M2_nondiag = calcMassMatrix_3gen(uVs)
     
-    #-- Define indices of non-zero values --#
-    # There are 14  unique values
-    # g[i] contains list of these index pairs in Mathematica notation (1 to 91)
-    # Ex. g[0] -> [[1,1]] -> M2_nondiag[0,0] = uV1
-    gIndex = [[[1, 1]], 
-             [[1, 91], [91, 1]], 
-             [[2, 2], [3, 3], [4, 4], [5, 5], [46, 46], [47, 47], [48, 48], [49, 49], [74, 74], [75, 75], [76, 76], [77, 77]], 
-             [[7, 7], [8, 8], [15, 15], [16, 16], [51, 51], [52, 52]], 
-             [[10, 10], [11, 11], [12, 12], [13, 13], [18, 18], [19, 19], [20, 20], [21, 21], [26, 26], [27, 27], [28, 28], 
-              [29, 29],[34, 34], [35, 35], [36, 36], [37, 37], [54, 54], [55, 55], [56, 56], [57, 57], [62, 62], [63, 63], 
-              [64, 64], [65, 65]], 
-             [[10, 26], [18, 34], [26, 10], [34, 18], [54, 62], [62, 54]], 
-             [[11, 27], [12, 28], [13, 29], [19, 35], [20, 36], [21, 37], [27, 11], [28, 12], [29, 13], [35, 19], [36, 20], 
-              [37, 21], [55, 63], [56, 64], [57, 65], [63, 55], [64, 56], [65, 57]], 
-             [[22, 22], [25, 25], [58, 58], [61, 61], [78, 78], [81, 81]], 
-             [[23, 23], [24, 24], [59, 59], [60, 60], [79, 79], [80, 80]], 
-             [[31, 31], [32, 32], [33, 33], [39, 39], [40, 40], [41, 41], [67, 67], [68, 68], [69, 69]], 
-             [[42, 42], [43, 43], [44, 44], [45, 45], [70, 70], [71, 71], [72, 72], [73, 73], [82, 82], [83, 83], [84, 84], 
-              [85, 85]], 
-             [[91, 91]]]
-    
-    #-- Loop over unique values and assign them to proper locations --#
-    for i in range(uVs.shape[0]):
-        arr = np.array(gIndex[i])
-        M2_nondiag[arr[:,0]-1, arr[:,1]-1] = uVs[i]
-    
-    #-- Numerically diagonalize M2_nondiag --#
+    #-- Diagonalize M2_nondiag block by block --#
     # M2arr_mass are eigenvalues in the mass basis order
-    # Wmatrix are normalized eigenvectors 
-    M2arr_mass, Wmatrix_mass = LA.eig(M2_nondiag)
+    # Wmatrix are normalized (real) eigenvectors 
+    global massMatrixBlocks
+    if massMatrixBlocks is None:
+        massMatrixBlocks = calcMassMatrixBlocks(gIndex_3gen)
+    M2arr_mass, Wmatrix_mass = diagonalizeMassMatrix(M2_nondiag, *massMatrixBlocks)
     
-    #Convert to real type
-    assert np.allclose(M2arr_mass.imag, 0., rtol=0., atol=1e-2) 
-    M2arr_mass = M2arr_mass.real
+    if DEBUG:
+        assert np.allclose(Wmatrix_mass.T @ M2_nondiag @ Wmatrix_mass, np.diag(M2arr_mass), rtol=0., 
+                           atol=1e-12*np.max(np.abs(M2arr_mass)))
+        assert np.allclose(np.sort(M2arr_mass), LA.eigvalsh(M2_nondiag), rtol=1e-10, atol=0.)
     
     #-- Convert M2arr_mass to M2arr_DMcharge --#
-    # New index: 0,  1, ..., 89, 90 <- np.arange(91)
-    # Old index: 0, 38, ..., 90,  1 <- indxArr
-    # Note: This assumes that we know how eigenvectors/eigenvalues are sorted when returned. 
-    #       This should be consistent for the same structured matrix
-    index_0 = np.array([0,  38,41,39,40,  50,53,51,52,  62,65,63,64,  70,73,71,72,  78,81,79,80,  82,85,83,84])
-    index_1 = np.arange(35+1)+2
-    index_2 = np.arange(7+1) +42
-    index_3 = np.arange(7+1) +54
-    index_4 = np.arange(3+1) +66
-    index_5 = np.arange(3+1) +74
-    index_6 = np.arange(4+1) +86
-    index_7 = np.array([1])
-    
-    indxArr = np.concatenate((index_0, index_1, index_2, index_3, index_4, index_5, index_6, index_7))
-
+    indxArr = indxArr_3gen
     M2arr_DMcharge = M2arr_mass[indxArr]
  
     #-- Identify pions which contain constituent DM --#
@@ -164,13 +276,48 @@ def calcPionMassSq_3gen(CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBU
     #-- Find M2DMarr --#
     M2DMarr = M2arr_DMcharge[DMindexArr]
     
+    if CACHE:
+        cachePut(eigenSystemCache, key, (M2arr_mass/(fpi*fpi), Wmatrix_mass, indxArr), eigenSystemCacheSize)
+    
     return M2arr_DMcharge, M2arr_mass, M2DMarr, Wmatrix_mass
 
-def calcPionMassSq(Ngen, CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG=True):
+#-- Mass spectra of many Ngen=3 parameter points at once --#
+def calcPionMassSq_3gen_batch(CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG=True):
+    """
+    lamW, fpi, mD, kappa: Arrays of N parameter points at one benchmark point (gs, eQ, sQsq)
+    
+    Returns M2arr_DMcharge (91, N), M2arr_mass (91, N) and M2DMarr (24, N) with the points as trailing axis, as 
+    calcPionMassSq_1gen and coannihilation.calcSigma_ij for several points, and the stack Wmatrix_mass (N, 91, 91).
+    The mass matrices of all points are assembled as one (N, 91, 91) stack and diagonalized together with the 
+    closed-form 2x2 block rotations, so the mass basis order is the same as for calcPionMassSq_3gen.
+    """
+    fpi, mD = np.broadcast_arrays(np.atleast_1d(fpi), np.atleast_1d(mD))
+    
+    uVs = calcUniqueVals(CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG)
+    if uVs is None:
+        return
+    M2_nondiag = calcMassMatrix_3gen(uVs)
+    
+    global massMatrixBlocks
+    if massMatrixBlocks is None:
+        massMatrixBlocks = calcMassMatrixBlocks(gIndex_3gen)
+    M2arr_mass, Wmatrix_mass = diagonalizeMassMatrix(M2_nondiag, *massMatrixBlocks)
+    
+    if DEBUG:
+        # One stacked call to LAPACK for all points, the exact zero eigenvalues come out at roundoff level
+        assert np.allclose(np.sort(M2arr_mass, axis=-1), LA.eigvalsh(M2_nondiag), rtol=1e-10, 
+                           atol=1e-12*np.max(np.abs(M2arr_mass)))
+    
+    M2arr_mass     = M2arr_mass.T
+    M2arr_DMcharge = M2arr_mass[indxArr_3gen]
+    
+    return M2arr_DMcharge, M2arr_mass, M2arr_DMcharge[np.arange(24)+1], Wmatrix_mass
+
+def calcPionMassSq(Ngen, CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG=True, CACHE=True):
     if(Ngen==1):
         return calcPionMassSq_1gen(CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG)
     elif(Ngen==3):
-        return calcPionMassSq_3gen(CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG)
+        return calcPionMassSq_3gen(CA, CG, CW, CZ, eQ, gs, sQsq, lamW, fpi, mD, kappa, DEBUG, CACHE)
     else:
         print("Error: Invalid Ngen. Please use either Ngen=1 or Ngen=3.")
         return 0
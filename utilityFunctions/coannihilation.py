@@ -1,5 +1,7 @@
 import numpy as np
 import itertools
+import os.path
+from os import path
 
 #############################
 ##
@@ -7,10 +9,8 @@ import itertools
 ##
 #############################
 
-#-- Calculate sigma_ij (2D array) (assuming v=0) --#
-def calcSigma_ij(M2, F1Mat, F2Mat, Ngen, aeff=True, DEBUG=True):
-    # Calculates DM_i DM_j -> SM SM
-    # Sums over all possible SM states
+#-- Get indices of DM and SM charged pions in DM charge basis --#
+def calcDMSMindexlists(Ngen):
     if(Ngen==1):
         n      = 15                        # Number of total pions (DM+SM)
         DMindexlist = np.arange(8)+5       # Indices of DM charged pions in DM charge basis, 5 to 12 by definition
@@ -23,24 +23,145 @@ def calcSigma_ij(M2, F1Mat, F2Mat, Ngen, aeff=True, DEBUG=True):
         SMindexlist = np.delete(SMindexlist, 0) # Ignore eta' (index 0)
     else:
         print("Error: Invalid Ngen. Please use either Ngen=1 or Ngen=3.")
-        return         
+        return 
+    
+    return n, DMindexlist, SMindexlist
+
+#-- Get the sectors of the basis the Fhat matrices are stored in (see tensorStore.writeBlockedTensors) --#
+def calcSectorIndexLists(Ngen):
+    """
+    Returns a dictionary {'D': ..., 'S': ..., 'E': ...} of index lists partitioning all pions.
+
+    For Ngen=1 the Fhat matrices are stored in the DM charge basis and D, S are DMindexlist, SMindexlist.
+    For Ngen=3 they are stored in the interaction basis and D (S) are the interaction states that mix into DM (SM)
+    charged pions for any parameters. These follow from the 2x2 block structure of the mass matrix and the fixed
+    mass to DM transformation, so F_DMbasis[D,D,S,S] only depends on F_intbasis[D,D,S,S].
+    E holds all remaining states (eta' for Ngen=1).
+    """
+    n, DMindexlist, SMindexlist = calcDMSMindexlists(Ngen)
+    if(Ngen==1):
+        D, S = DMindexlist, SMindexlist
+    elif(Ngen==3):
+        from calcPionMassSq import gIndex_3gen, calcMassMatrixBlocks, diagonalizeMassMatrix
+        from convertToDMBasis import calcDMTransformMatrix
+
+        # Generic mass matrix with the block structure of M2_nondiag, so no entry of W vanishes by accident
+        pairIndx, singleIndx = calcMassMatrixBlocks(gIndex_3gen)
+        M2_generic = np.diag(np.arange(1., n+1.))
+        M2_generic[pairIndx[:,0], pairIndx[:,1]] = M2_generic[pairIndx[:,1], pairIndx[:,0]] = 0.5
+        _, Wgeneric = diagonalizeMassMatrix(M2_generic, pairIndx, singleIndx)
+
+        WVsupport = np.abs(Wgeneric) @ np.abs(calcDMTransformMatrix(Ngen, DEBUG=False))
+        D = np.nonzero(WVsupport[:, DMindexlist].sum(axis=1))[0]
+        S = np.nonzero(WVsupport[:, SMindexlist].sum(axis=1))[0]
+        assert len(np.intersect1d(D, S)) == 0
+    else:
+        return
+
+    return {'D': D, 'S': S, 'E': np.setdiff1d(np.arange(n), np.concatenate([D, S]))}
+
+#-- Calculate flat F1Mat/F2Mat indices of G1, ..., G7 for all DM DM -> SM SM reactions --#
+def calcChannelGatherTable(Ngen):
+    """
+    Returns an integer array of shape (7, nPairs, nSM, nSM). Entry [k, pair, c, d] is the index into F1Mat.ravel()
+    (F2Mat.ravel() for k=6) of the diagram factor G_{k+1} from crossSection.calcDiagramFactors for the reaction 
+    DM_i DM_j -> SM_c SM_d, where (i, j) is the pair-th DM pair with i<=j (as laid out in calcSigma_ij).
+    The table only depends on Ngen.
+    """
+    from crossSection import diagramFactorOrders
+    n, DMindexlist, SMindexlist = calcDMSMindexlists(Ngen)
+    
+    iPair, jPair = np.triu_indices(len(DMindexlist))
+    shape   = (len(iPair), len(SMindexlist), len(SMindexlist))
+    indices = {'a': DMindexlist[iPair][:, None, None], 'b': DMindexlist[jPair][:, None, None], 
+               'c': SMindexlist[None, :, None],        'd': SMindexlist[None, None, :]}
     
-    sig = np.zeros((n, n), dtype=complex)    
+    table = np.zeros((len(diagramFactorOrders),) + shape, dtype=np.int32) # n^4 < 2^31 for Ngen=1 and 3
+    for k, (FMat, order) in enumerate(diagramFactorOrders):
+        table[k] = np.ravel_multi_index(np.broadcast_arrays(*[indices[x] for x in order]), (n, n, n, n))
     
-    allDM = itertools.combinations_with_replacement(DMindexlist, r=2) # Accounts for symmetry in i,j
-    allSM = itertools.product(SMindexlist, SMindexlist)
+    return table
 
-    total = itertools.product(allDM, allSM) # Need this step because nesting loops over itertools doesn't work
+#-- Cache of channel gather tables, filled on first use --#
+channelGatherTables = {}
 
-    # Get masses of particles (not mass-squareds)
-    particleMasses = np.sqrt(M2)
+#-- Get channel gather table from memory, from file, or calculate and store it --#
+# Only calcSigma_ij with full F1Mat, F2Mat (no Gfactors) needs the table, so it is built lazily on the first such call
+def getChannelGatherTable(Ngen):
+    
+    if Ngen not in channelGatherTables:
+        filename = "Data/npyFiles/channelGatherTable_Ngen%d.npy"%Ngen
+        if path.isdir(os.path.dirname(filename)):
+            # Built once (stamped and under a lock, see tensorStore.ensureArtifact) and memory mapped, so that 
+            # processes on one node share the table
+            from tensorStore import ensureArtifact, saveArray, writeArtifactStamp, openTensor
+            def builder():
+                saveArray(filename, calcChannelGatherTable(Ngen))
+                writeArtifactStamp(filename, Ngen, 'ChannelGatherTable')
+            if ensureArtifact(filename, Ngen, 'ChannelGatherTable', builder):
+                channelGatherTables[Ngen] = openTensor(filename, Ngen)
+        if Ngen not in channelGatherTables:
+            channelGatherTables[Ngen] = calcChannelGatherTable(Ngen)
+    
+    return channelGatherTables[Ngen]
+
+#-- Calculate G1, ..., G7 in the sector layout from full F1Mat, F2Mat in DM charge basis --#
+def calcSectorDiagramFactors(F1Mat, F2Mat, Ngen):
+    # Returns G1, ..., G7 of shape (nDM, nDM, nSM, nSM), as read by calcSigma_ij through Gfactors
+    from calcF1F2hat import F1HatPatterns, F2HatPatterns
+    from crossSection import calcDiagramFactorsSector
+    n, DMindexlist, SMindexlist = calcDMSMindexlists(Ngen)
+    
+    sectorIndices = {'D': DMindexlist, 'S': SMindexlist}
+    F1Blocks = {p: F1Mat[np.ix_(*[sectorIndices[i] for i in p])] for p in F1HatPatterns}
+    F2Blocks = {p: F2Mat[np.ix_(*[sectorIndices[i] for i in p])] for p in F2HatPatterns}
+    
+    return tuple(np.ascontiguousarray(G) for G in calcDiagramFactorsSector(F1Blocks, F2Blocks))
+
+#-- Calculate sigma_ij (2D array) (assuming v=0) --#
+def calcSigma_ij(M2, F1Mat, F2Mat, Ngen, aeff=True, DEBUG=True, Gfactors=None):
+    # Calculates DM_i DM_j -> SM SM
+    # Sums over all possible SM states
+    #
+    # Gfactors: Optional diagram factors G1, ..., G7 in the sector layout of crossSection.calcDiagramFactorsSector,
+    #           shape (nDM, nDM, nSM, nSM) each. If given, F1Mat and F2Mat are not read.
+    #
+    # Several parameter points are calculated at once if M2 has shape (n, N) and Gfactors have shape 
+    # (nDM, nDM, nSM, nSM, N), sig then has shape (n, n, N). This requires Gfactors.
+    if Ngen not in [1, 3]:
+        print("Error: Invalid Ngen. Please use either Ngen=1 or Ngen=3.")
+        return         
+    n, DMindexlist, SMindexlist = calcDMSMindexlists(Ngen)
+    
+    batchShape = np.shape(M2)[1:]
+    if batchShape != () and Gfactors is None:
+        print("Error: Gfactors are required to calculate several parameter points at once.")
+        return
+    sig = np.zeros((n, n) + batchShape, dtype=complex)    
+    
+    # All pairs i<=j of DM pions (accounts for symmetry in i,j) and all pairs c,d of SM pions
+    # Reactions are laid out on a (pair, c, d) grid and calculated at once (indexing M2 appends the parameter points)
+    iPair, jPair = np.triu_indices(len(DMindexlist))
+    i = DMindexlist[iPair][:, None, None]
+    j = DMindexlist[jPair][:, None, None]
+    c = SMindexlist[None, :, None]
+    d = SMindexlist[None, None, :]
+    
+    if Gfactors is None:
+        # Gather G1, ..., G7 from the flattened F1Mat, F2Mat with the precomputed table
+        table = getChannelGatherTable(Ngen)
+        F1flat, F2flat = np.ravel(F1Mat), np.ravel(F2Mat)
+        G = tuple(np.take(F1flat, table[k]) for k in range(6)) + (np.take(F2flat, table[6]),)
+    else:
+        G = tuple(Gk[iPair, jPair] for Gk in Gfactors)
 
     #-- If we are calculating a_eff --# 
     from crossSection import calcCrossSection
     if (aeff):
-        for ((i,j),(c,d)) in total:           
-            sig[i,j] += calcCrossSection(i, j, c, d, M2, F1Mat, F2Mat, DEBUG)
-            sig[j,i] = sig[i,j]
+        # Sum over all possible SM states
+        sigPairs = np.sum(calcCrossSection(i, j, c, d, M2, F1Mat, F2Mat, DEBUG, G), axis=(1, 2))
+        sig[DMindexlist[iPair], DMindexlist[jPair]] = sigPairs
+        sig[DMindexlist[jPair], DMindexlist[iPair]] = sigPairs
     else:
         print("Function not set up to handle aeff=False case.")
 
@@ -48,25 +169,27 @@ def calcSigma_ij(M2, F1Mat, F2Mat, Ngen, aeff=True, DEBUG=True):
 
 #-- Calculate Delta --#
 def calcDelta(mi, m1):
-    assert (m1 != 0.)
+    assert np.all(m1 != 0.)
     return (mi - m1)/m1
 
 #-- Calculate g_eff --#
 def calcGeff2(g, delta, x):
     dummyArr = g*(1+delta)**(3./2.)*np.exp(-x*delta)
-    return np.sum(dummyArr)**2
+    return np.sum(dummyArr, axis=0)**2
 
 #-- Calculate effective cross-section to zeroth order in v --#
 def calcaEff(sigma, mDMarr, g, x, Ngen, DEBUG=True):
+    # mDMarr of shape (nDM, N) and sigma of shape (n, n, N) give aeff for N parameter points at once
 
-    m1 = np.min(mDMarr) # Whichever DM particle is the lightest
+    m1 = np.min(mDMarr, axis=0) # Whichever DM particle is the lightest
 
     # Get delta values
     delta = calcDelta(mDMarr, m1)
+    g     = np.reshape(g, np.shape(g) + (1,)*(np.ndim(mDMarr) - 1))
 
     # Get g_eff squared
     geff2 = calcGeff2(g, delta, x)
-    assert (geff2 != 0.)
+    assert np.all(geff2 != 0.)
 
     # Calculate aeff
     if(Ngen==1):
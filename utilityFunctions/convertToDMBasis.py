@@ -96,7 +96,10 @@ def calcDMTransformMatrix(Ngen, DEBUG=True):
 def convertToDMBasis(F1Matrix, F2Matrix, Vmatrix, DEBUG=True):
     
     #-- Transform Fs from interaction to DM charge basis --#
-    from transformFs import transformF
+    # Vmatrix is the identity except for 2x2 blocks on the A/B/D indices, so apply it with index remaps
+    from transformFs import transformF, StructuredTransform
+    if not isinstance(Vmatrix, StructuredTransform):
+        Vmatrix = StructuredTransform.fromDense(Vmatrix)
     F1DMchargeBasisMatrix = transformF(Vmatrix, F1Matrix, DEBUG)
     F2DMchargeBasisMatrix = transformF(Vmatrix, F2Matrix, DEBUG)
 
@@ -1,5 +1,8 @@
 import numpy as np
 
+#-- Index order of F1Mat/F2Mat for each factor G1, ..., G7, relative to the reaction indices a, b, c, d --#
+diagramFactorOrders = [('F1', 'abcd'), ('F1', 'dbca'), ('F1', 'cdab'), ('F1', 'acbd'), ('F1', 'adcb'), ('F1', 'cbad'), ('F2', 'abcd')]
+
 #-- Calculate factors from Feynman diagrams --#
 def calcDiagramFactors(a, b, c, d, F1Mat, F2Mat):
     G1 = F1Mat[a, b, c, d]
@@ -12,10 +15,33 @@ def calcDiagramFactors(a, b, c, d, F1Mat, F2Mat):
     
     return G1, G2, G3, G4, G5, G6, G7
 
+#-- Calculate factors from Feynman diagrams for all DM DM -> SM SM reactions at once --#
+def calcDiagramFactorsSector(F1Blocks, F2Blocks):
+    """
+    F1Blocks, F2Blocks: Dictionaries from index pattern (e.g. 'SDSD') to block of F1Mat (F2Mat) restricted to that 
+                        pattern of DM (D) and SM (S) indices, as returned by transformFs.transformFSector or 
+                        calcF1F2hat.calcF1F2HatBlocks.
+    
+    Returns G1, ..., G7 in the sector layout: arrays of shape (nDM, nDM, nSM, nSM) with G[i,j,c,d] equal to 
+    calcDiagramFactors(DMindexlist[i], DMindexlist[j], SMindexlist[c], SMindexlist[d], F1Mat, F2Mat).
+    """
+    blocks = {'F1': F1Blocks, 'F2': F2Blocks}
+    
+    G = []
+    for (FMat, order) in diagramFactorOrders:
+        # Reaction indices a, b are DM pions and c, d are SM pions
+        pattern = ''.join('D' if i in 'ab' else 'S' for i in order)
+        G.append(np.einsum(order + '->abcd', blocks[FMat][pattern]))
+    
+    return tuple(G)
+
 #-- Calculate components of cross section --#
-def calcCrossSectionConstants(a, b, c, d, s, M2, F1Mat, F2Mat):
+def calcCrossSectionConstants(a, b, c, d, s, M2, F1Mat, F2Mat, G=None):
   
-    G1, G2, G3, G4, G5, G6, G7 = calcDiagramFactors(a, b, c, d, F1Mat, F2Mat)
+    # G: Diagram factors G1, ..., G7 if already known, otherwise read from F1Mat, F2Mat
+    if G is None:
+        G = calcDiagramFactors(a, b, c, d, F1Mat, F2Mat)
+    G1, G2, G3, G4, G5, G6, G7 = G
     
     C = 0.5*( 2*G7 + M2[a]*(G2 + G3 - G5) + M2[b]*(G3 + G4 - G6) + M2[c]*(G1 + G2 - G6) + M2[d]*(G1 + G4 - G5) )
     Ccc = C.conjugate()
@@ -38,19 +64,21 @@ def lambdaFunc(s, c, d, M2):
 
 #-- Define useful notational constant for describing bounds of the t integral --#
 def W1(s, a, b, c, d, M2):
-    assert s != 0.
+    assert np.all(s != 0.)
     W1 = M2[a] + M2[c] - (1/(2.*s))*(s + M2[a] - M2[b])*(s + M2[c] - M2[d])
     return W1
 
 #-- Calculate the cross section for 2-to-2 reactions of the form \Pi^+_a \Pi^-_b -> \Pi^0_c \Pi^0_d --#
-def calcCrossSection(a, b, c, d, M2, F1Mat, F2Mat, DEBUG):
+def calcCrossSection(a, b, c, d, M2, F1Mat, F2Mat, DEBUG, G=None):
+    # a, b, c, d may be integers or broadcastable integer arrays (with G of the broadcast shape), in which case
+    # the cross sections of all reactions are calculated at once and returned as an array
 
     # Create Mass array
     massArr = np.sqrt(M2)
 
     # Calculate s for v=0 condition
     s = (massArr[a] + massArr[b])**2
-    assert s != 0.
+    assert np.all(s != 0.)
 
     # Calculate lambda
     lam = lambdaFunc(s, c, d, M2)
@@ -58,7 +86,7 @@ def calcCrossSection(a, b, c, d, M2, F1Mat, F2Mat, DEBUG):
         print('Lambda:',lam)
 
     # Calculate coeffs
-    Cconst, Clin, Cquad = calcCrossSectionConstants(a, b, c, d, s, M2, F1Mat, F2Mat)
+    Cconst, Clin, Cquad = calcCrossSectionConstants(a, b, c, d, s, M2, F1Mat, F2Mat, G)
     if (DEBUG): 
         print('Cconst, Clin, Cquad: ',Cconst, Clin, Cquad)
 
@@ -68,15 +96,13 @@ def calcCrossSection(a, b, c, d, M2, F1Mat, F2Mat, DEBUG):
         print('W1: ',W1val)
 
     # Calculate s-wave Cross Section
-    assert massArr[a] != 0. and massArr[b] != 0.
+    assert np.all(massArr[a] != 0.) and np.all(massArr[b] != 0.)
    
-    if(lam<=0.): 
-        sig = 0j
-    else: 
-        sig = (1./(32.*np.pi*massArr[a]*massArr[b]))*(np.sqrt(lam)/s)*(Cconst + Clin*W1val + Cquad*(W1val**2))
+    # Kinematically forbidden reactions (lam<=0) do not contribute
+    sig = (1./(32.*np.pi*massArr[a]*massArr[b]))*(np.sqrt(np.maximum(lam, 0.))/s)*(Cconst + Clin*W1val + Cquad*(W1val**2))
+    sig = np.where(lam<=0., 0j, sig)
 
     small_num = 1e-20 # Impose lower threshold on value of sig 
-    if (np.abs(sig) < small_num):
-        return 0j
-    else:
-        return sig
+    sig = np.where(np.abs(sig) < small_num, 0j, sig)
+    
+    return sig[()] # Scalar for scalar a, b, c, d
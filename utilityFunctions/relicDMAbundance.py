@@ -7,6 +7,7 @@ from scipy.integrate import quad, ode, solve_ivp, odeint
 from scipy.optimize import root
 from scipy.special import zeta
 from scipy.special import kn
+from bisect import bisect_right
 
 ######################################
 ##
@@ -58,6 +59,19 @@ def gstarS(T): return interpolate.splev(T, tckS, der = 0)
 
 def dgstarSdT(T): return interpolate.splev(T, tckS, der = 1)
 
+#-- g*S(T) and its derivative from one interval lookup, for the many scalar calls of FBEqs --#
+# The spline is converted to a polynomial on each knot interval, which is several times faster than splev for 
+# scalar T and agrees with it to ~1e-11 (relative), well below the rtol of the Boltzmann solver
+ppS  = interpolate.PPoly.from_spline(tckS)
+ppSx = ppS.x.tolist()
+ppSc = ppS.c.T.tolist()
+
+def gstarSDerivs(T):
+    i = min(max(bisect_right(ppSx, T) - 1, 0), len(ppSc) - 1)
+    d = T - ppSx[i]
+    c0, c1, c2, c3 = ppSc[i]
+    return ((c0*d + c1)*d + c2)*d + c3, (3.*c0*d + 2.*c1)*d + c2
+
 ##----------------------------##
 ##  Define Boltzman equation  ##  
 ##----------------------------##
@@ -77,8 +91,9 @@ def FBEqs( a, v, nphi, mDM, sv):
     NDM   = v[1]                            # DM number density
     Tp    = v[2]                            # Temperature
     
+    gS, dgS = gstarSDerivs(Tp)
     H   = np.sqrt(25.13274122871834 * GCF * (rRAD * 10.**(-4*a))/3.)    # Hubble parameter
-    Del = 1. + Tp * dgstarSdT(Tp)/(3. * gstarS(Tp))                     # Temperature parameter
+    Del = 1. + Tp * dgS/(3. * gS)                                       # Temperature parameter
 
     #-- Radiation + Temperature equations --#
     
@@ -91,11 +106,9 @@ def FBEqs( a, v, nphi, mDM, sv):
     
     dNDMda = -(NDM*NDM - NDMeq*NDMeq)*sv*nphi/(H*10.**(3.*a))
     
-    dEqsda = [drRADda, dNDMda, dTda]
-
-    dEqsda = [x * 2.3025 for x in dEqsda]
+    dEqsda = np.array([drRADda, dNDMda, dTda])
     
-    return dEqsda
+    return 2.3025*dEqsda
 
 ##----------------------------##
 ##  Test thermalization value ##
@@ -106,11 +119,17 @@ def testThermalization(sigmaW, t, NDM, nphi, H):
 ##-------------------------------------------------------------##
 ##  Calculate relic density of DM constituent post deconfiment ##
 ##-------------------------------------------------------------##
-def calcOmegaH2(mDM, mDMcon, sv):
+def calcOmegaH2(mDM, mDMcon, sv, DENSE=False, STATS=False, aStart=0.):
     """
     mDM:    Mass of lightest DM pion
     mDMcon: Mass of DM constituent (DM candidate)
     sv:     Coannihilation thermally averaged cross section, relative velocity v=0, non-relativistic colliding particles 
+    DENSE:  Build the continuous solution (solFBE.sol), only useful together with STATS
+    STATS:  Also return a dictionary of solver statistics (nfev, njev, nlu, nsteps, success) and the continuous 
+            solution 'sol' (None unless DENSE)
+    aStart: Opt-in change of method. For aStart > 0 (e.g. 1e-13) the solver starts at a = aStart from the closed-form 
+            solution of the initial annihilation transient (see below) instead of integrating it numerically from 
+            a = 0, which takes ~4-7 times fewer steps and changes oh2 by ~1e-11 relative
     """
     Ti     = mDM                                        # Initial Universe temperature
     rRadi  = 0.3289868133696 * gstar(Ti) * Ti*Ti*Ti*Ti  # Initial radiation energy density -- assuming a radiation Universe
@@ -118,14 +137,29 @@ def calcOmegaH2(mDM, mDMcon, sv):
     
     v0 = [rRadi, nphi, Ti]
     
+    #-- Initial annihilation transient --#
+    # NDM starts far above NDMeq and drops by many orders of magnitude over a ~ 1e-30 to 1e-13, which takes most of
+    # the solver steps. Over this range the coefficients of dNDM/da = -k(NDM^2 - NDMeq^2) are constant to O(a), so 
+    # NDM = NDMeq coth(k NDMeq a + arccoth(NDM/NDMeq)) there and with aStart > 0 the solver starts at aStart instead.
+    H0     = np.sqrt(25.13274122871834 * GCF * rRadi/3.)
+    NDMeq0 = (mDM*mDM * Ti * kn(2, mDM/Ti))/(9.8696044)/nphi
+    if aStart > 0. and nphi > NDMeq0 > 0.:
+        k      = 2.3025*sv*nphi/H0
+        Del0   = 1. + Ti * dgstarSdT(Ti)/(3. * gstarS(Ti))
+        NStart = NDMeq0/np.tanh(k*NDMeq0*aStart + 0.5*np.log1p(2./(nphi/NDMeq0 - 1.)))
+        vStart = [rRadi, NStart, Ti*np.exp(-2.3025*aStart/Del0)]
+    else:
+        aStart, vStart = 0., v0
+    
     #-- Solve Boltzmann Equation --#
     solFBE = solve_ivp(lambda t, z: FBEqs( t, z,  nphi, mDM, sv),
-                                   [0, 2.0], v0, method='Radau',  rtol=1.e-10, atol=1.e-20, dense_output=True)
+                                   [aStart, 2.0], vStart, method='Radau',  rtol=1.e-10, atol=1.e-20, dense_output=DENSE)
 
-    t    = solFBE.t[:]
-    Rad  = solFBE.y[0]
-    NDM  = solFBE.y[1]
-    T    = solFBE.y[2]
+    # The initial state at a = 0 is kept as first point
+    t    = np.concatenate(([0.], solFBE.t)) if aStart > 0. else solFBE.t[:]
+    Rad  = np.concatenate(([v0[0]], solFBE.y[0])) if aStart > 0. else solFBE.y[0]
+    NDM  = np.concatenate(([v0[1]], solFBE.y[1])) if aStart > 0. else solFBE.y[1]
+    T    = np.concatenate(([v0[2]], solFBE.y[2])) if aStart > 0. else solFBE.y[2]
     H   = np.sqrt(25.13274122871834* GCF * (Rad * 10.**(-4*t))/3.)
     
     alphaW = 0.0338
@@ -143,4 +177,9 @@ def calcOmegaH2(mDM, mDMcon, sv):
     #-- Test thermalization and store value --#
     therm = testThermalization(sigmaW, t, NDM, nphi, H)
     
+    if STATS:
+        stats = {'nfev': solFBE.nfev, 'njev': solFBE.njev, 'nlu': solFBE.nlu, 'nsteps': len(solFBE.t) - 1, 
+                 'success': solFBE.success, 'sol': solFBE.sol}
+        return Oh2, therm, stats
+    
     return Oh2, therm
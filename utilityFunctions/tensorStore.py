@@ -0,0 +1,306 @@
+import numpy as np
+import os
+import os.path
+from os import path
+from collections import OrderedDict
+
+#################################################################
+##
+## Memory-mapped store and cache of the precalculated tensors
+##
+#################################################################
+
+# The .npy artifacts in Data/npyFiles/ are opened with mmap_mode='r'. The memory maps are backed by the page
+# cache, so all processes on a node (e.g. MPI ranks of uls-nest or a multiprocessing pool) that open the same
+# file share one physical copy, and opening a file is near-instant since pages are only read once touched.
+# (multiprocessing.shared_memory would need Python >= 3.8 and explicit cleanup of the segments.)
+#
+# Every loaded artifact is kept under the key (absolute path, mtime, Ngen, loader), so repeated omegaH2 calls in 
+# one process touch the disk once. Rewriting a file changes its mtime, which drops the stale entry on the next load.
+# Memory maps do not count towards the size bound (their pages belong to the page cache), arrays held in memory 
+# (e.g. the expanded Ngen=3 trace tensors) do. The least recently used entries are evicted beyond the bound.
+
+#-- Loaded artifacts, key -> (object, size in bytes) --#
+artifactCache         = OrderedDict()
+artifactCacheMaxBytes = 2*1024**3
+
+#-- Memory held by an artifact, memory maps excluded --#
+def calcArtifactBytes(artifact):
+    if isinstance(artifact, np.memmap):
+        return 0
+    elif isinstance(artifact, np.ndarray):
+        return 0 if isinstance(artifact.base, np.memmap) else artifact.nbytes
+    elif isinstance(artifact, (tuple, list)):
+        return sum(calcArtifactBytes(a) for a in artifact)
+    elif isinstance(artifact, dict):
+        return sum(calcArtifactBytes(a) for a in artifact.values())
+    return 0
+
+#-- Total memory held by the artifact cache --#
+def getArtifactCacheBytes():
+    return sum(nbytes for (_, nbytes) in artifactCache.values())
+
+#-- Open a .npy file as a read-only memory map --#
+def loadMemmap(filename):
+    return np.load(filename, mmap_mode='r')
+
+#-- Load an artifact with loader(filename), reusing it if this process loaded the same file before --#
+def loadArtifact(filename, loader=loadMemmap, Ngen=None):
+    """
+    filename: Path of the artifact, e.g. "Data/npyFiles/VMatrix_massToDM_Ngen3.npy"
+    loader:   Function filename -> object, by default a read-only memory map of a .npy file
+    Ngen:     Stored in the key, so artifacts derived for different Ngen from one file are kept apart
+    
+    Returns None (after printing an error) if the file does not exist or the loader fails.
+    """
+    if (path.exists(filename) == False):
+        print("Error: %s does not exists. Please run preScan.py before proceeding."%filename)
+        return
+    
+    filename = path.abspath(filename)
+    key = (filename, os.stat(filename).st_mtime_ns, Ngen, loader.__name__)
+    if key in artifactCache:
+        artifactCache.move_to_end(key)
+        return artifactCache[key][0]
+    
+    #-- Drop entries for older versions of this file --#
+    invalidateArtifacts(filename, keep=key[1])
+    
+    artifact = loader(filename)
+    nbytes   = calcArtifactBytes(artifact)
+    if artifact is not None and nbytes <= artifactCacheMaxBytes:
+        artifactCache[key] = (artifact, nbytes)
+        while getArtifactCacheBytes() > artifactCacheMaxBytes:
+            artifactCache.popitem(last=False)
+    
+    return artifact
+
+#-- Drop cached artifacts of one file (or all files), e.g. after a file has been rewritten --#
+def invalidateArtifacts(filename=None, keep=None):
+    # keep: mtime of the entries of filename to keep
+    if filename is None:
+        artifactCache.clear()
+        return
+    filename = path.abspath(filename)
+    for key in [k for k in artifactCache if k[0] == filename and k[1] != keep]:
+        del artifactCache[key]
+
+#-- Open a .npy file as a read-only memory map, reusing it if this process opened it before --#
+def openTensor(filename, Ngen=None):
+    return loadArtifact(filename, Ngen=Ngen)
+
+#-- Drop all memory maps of this process (e.g. after a file has been rewritten) --#
+def closeTensors():
+    invalidateArtifacts()
+
+#################################################################
+##
+## Sector-blocked tensor files
+##
+#################################################################
+
+# Layout of a blocked file (.blk):
+#   magic string blockedMagic
+#   header length (uint64, little endian)
+#   header (JSON): n, dtype, sectors {label: indices}, tensors [names] and the block index 
+#                  [{tensor, pattern, shape, offset}], where block (tensor, pattern) holds 
+#                  tensor[np.ix_(sectors[pattern[0]], ..., sectors[pattern[3]])] in C order at byte offset
+#   block payloads, each aligned to blockAlign bytes
+# A reader only touches the header and the requested blocks.
+
+blockedMagic = b'SU2LDMBLK1'
+blockAlign   = 64
+
+#-- Write the sector blocks of 4 index tensors to a blocked file --#
+def writeBlockedTensors(filename, getBlock, tensorNames, sectors, patterns=None, dtype=complex):
+    """
+    getBlock:    Function (tensorName, indexLists) -> dense block tensor[np.ix_(*indexLists)]
+    tensorNames: Names of the tensors, e.g. ['F1', 'F2']
+    sectors:     Dictionary from sector label to index list, e.g. {'D': DMindexlist, 'S': SMindexlist, 'E': [0]}
+    patterns:    Dictionary from tensor name to list of patterns to store. By default all len(sectors)^4 blocks
+                 are stored, so the full tensors can be recovered.
+    """
+    import json, itertools
+    
+    dtype   = np.dtype(dtype)
+    sectors = {label: [int(i) for i in indices] for label, indices in sectors.items()}
+    n       = sum(len(indices) for indices in sectors.values())
+    if patterns is None:
+        allPatterns = [''.join(p) for p in itertools.product(sectors.keys(), repeat=4)]
+        patterns = {name: allPatterns for name in tensorNames}
+    
+    #-- Block index, offsets are relative to the start of the payloads until the header size is known --#
+    blocks = []
+    offset = 0
+    for name in tensorNames:
+        for pattern in patterns[name]:
+            shape = [len(sectors[label]) for label in pattern]
+            blocks.append({'tensor': name, 'pattern': pattern, 'shape': shape, 'offset': offset})
+            offset += -(-int(np.prod(shape))*dtype.itemsize//blockAlign)*blockAlign
+    
+    header = {'n': n, 'dtype': dtype.str, 'sectors': sectors, 'tensors': list(tensorNames), 'blocks': blocks}
+    headerLength = len(json.dumps(header).encode()) + 32*len(blocks) + 64 # Room for the final offsets
+    start = -(-(len(blockedMagic) + 8 + headerLength)//blockAlign)*blockAlign
+    for block in blocks:
+        block['offset'] += start
+    headerBytes = json.dumps(header).encode().ljust(headerLength)
+    
+    #-- Write header and payloads, one block in memory at a time --#
+    with open(filename+".tmp", 'wb') as f:
+        f.write(blockedMagic)
+        f.write(np.uint64(headerLength).tobytes())
+        f.write(headerBytes)
+        for block in blocks:
+            data = np.ascontiguousarray(getBlock(block['tensor'], [sectors[label] for label in block['pattern']]), 
+                                        dtype=dtype)
+            assert list(data.shape) == block['shape']
+            f.seek(block['offset'])
+            f.write(data.tobytes())
+    os.replace(filename+".tmp", filename)
+
+#-- Convert a .npy file with [T_0, T_1, ...] of shape (nTensors, n, n, n, n) to a blocked file --#
+def convertToBlocked(npyFilename, blkFilename, sectors, tensorNames=('F1', 'F2'), patterns=None):
+    tensors = np.load(npyFilename, mmap_mode='r')
+    def getBlock(name, indexLists):
+        return tensors[tensorNames.index(name)][np.ix_(*indexLists)]
+    writeBlockedTensors(blkFilename, getBlock, list(tensorNames), sectors, patterns, tensors.dtype)
+
+#-- Read the header of a blocked file and map its payloads --#
+def loadBlockedFile(filename):
+    import json
+    
+    with open(filename, 'rb') as f:
+        if f.read(len(blockedMagic)) != blockedMagic:
+            print("Error: %s is not a blocked tensor file."%filename)
+            return
+        headerLength = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(headerLength).decode())
+    header['index'] = {(block['tensor'], block['pattern']): block for block in header['blocks']}
+    header['data']  = np.memmap(filename, dtype=np.uint8, mode='r')
+    
+    return header
+
+#-- Read the header of a blocked file, reusing it if this process read it before --#
+def readBlockedHeader(filename):
+    return loadArtifact(filename, loadBlockedFile)
+
+#-- Read a single block of a blocked file as a read-only memory map --#
+def readTensorBlock(filename, tensorName, pattern):
+    header = readBlockedHeader(filename)
+    if header is None:
+        return
+    if (tensorName, pattern) not in header['index']:
+        print("Error: Block %s of %s is not stored in %s."%(pattern, tensorName, filename))
+        return
+    block  = header['index'][(tensorName, pattern)]
+    dtype  = np.dtype(header['dtype'])
+    nbytes = int(np.prod(block['shape']))*dtype.itemsize
+    return header['data'][block['offset']:block['offset']+nbytes].view(dtype).reshape(block['shape'])
+
+#-- Read several blocks of one tensor, returns a dictionary pattern -> block --#
+def readTensorBlocks(filename, tensorName, patterns):
+    blocks = {pattern: readTensorBlock(filename, tensorName, pattern) for pattern in patterns}
+    if any(block is None for block in blocks.values()):
+        return
+    return blocks
+
+#################################################################
+##
+## Stamped artifacts, built on demand
+##
+#################################################################
+
+# Every file written by preScan.py has a stamp file (filename+".stamp") recording Ngen, the artifact kind and the 
+# format version of that kind. A file is only used if its stamp matches the current version, otherwise (or if it is 
+# missing) it is rebuilt on first use. Builds hold an exclusive lock, so concurrent workers wait for the first one 
+# instead of building the same file again.
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows, builds are then not locked
+    fcntl = None
+
+#-- Format version of each kind of artifact --#
+# Increase the version of a kind whenever a code change alters the content or layout of its files (e.g. the basis 
+# conventions in calcMatrices, convertToDMBasis or calcPionMassSq, the sector layout of coannihilation or the 
+# diagram factors of crossSection), so that files built by older code are rebuilt on first use. Changes that leave 
+# the files unchanged (comments, refactoring, speed) keep the committed files valid.
+artifactVersions = {'Trace':              1,
+                    'FhatDense':          1,
+                    'Vmatrix':            1,
+                    'Fhat':               1,
+                    'FhatBlocked':        1,
+                    'GHat':               1,
+                    'ChannelGatherTable': 1}
+
+#-- Stamp of an artifact built by the current code --#
+def calcArtifactStamp(Ngen, kind):
+    return {'Ngen': Ngen, 'kind': kind, 'version': artifactVersions[kind]}
+
+#-- Mark filename as built by the current code --#
+def writeArtifactStamp(filename, Ngen, kind):
+    import json
+    
+    with open(filename+".stamp.tmp", 'w') as f:
+        json.dump(calcArtifactStamp(Ngen, kind), f, sort_keys=True)
+    os.replace(filename+".stamp.tmp", filename+".stamp")
+
+#-- Files found fresh by this process, (path, mtimes of file and stamp, Ngen, kind) --#
+freshArtifacts = set()
+
+#-- Check that filename exists and was built by the current code --#
+def isArtifactFresh(filename, Ngen, kind):
+    import json
+    
+    if (path.exists(filename) == False or path.exists(filename+".stamp") == False):
+        return False
+    
+    # The stamp is only read again if the file or the stamp changed
+    key = (path.abspath(filename), os.stat(filename).st_mtime_ns, os.stat(filename+".stamp").st_mtime_ns, Ngen, kind)
+    if key not in freshArtifacts:
+        try:
+            with open(filename+".stamp") as f:
+                if json.load(f) != calcArtifactStamp(Ngen, kind):
+                    return False
+        except ValueError:
+            return False
+        freshArtifacts.add(key)
+    
+    return True
+
+#-- Save an array to a .npy file, replacing the file in one step so open memory maps stay valid --#
+def saveArray(filename, arr):
+    with open(filename+".tmp", 'wb') as f:
+        np.save(f, arr)
+    os.replace(filename+".tmp", filename)
+
+#-- Make sure filename is fresh, building it with builder() under lockFilename if not --#
+def ensureArtifact(filename, Ngen, kind, builder, lockFilename=None):
+    """
+    builder:      Function without arguments writing (and stamping) filename, e.g. a call to preScan
+    lockFilename: Lock held while building, by default filename+".lock". Artifacts built together should share it.
+    
+    Returns True if filename is fresh afterwards.
+    """
+    if isArtifactFresh(filename, Ngen, kind):
+        return True
+    
+    if lockFilename is None:
+        lockFilename = filename+".lock"
+    with open(lockFilename, 'a') as lockFile:
+        if fcntl is not None:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            # Another process may have built it while we were waiting
+            if not isArtifactFresh(filename, Ngen, kind):
+                print("%s is missing or out of date, building it now."%filename)
+                builder()
+                invalidateArtifacts(filename)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+    
+    if not isArtifactFresh(filename, Ngen, kind):
+        print("Error: Could not build %s."%filename)
+        return False
+    return True
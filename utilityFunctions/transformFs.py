@@ -1,5 +1,65 @@
 import numpy as np
 
+#################################################################
+##
+## Structured transformation matrices
+##
+#################################################################
+
+class StructuredTransform:
+    """
+    Transformation matrix V with at most k non-zero entries per column, stored as 
+        V[:, e] = sum_l coeffs[e,l] * (unit vector along rows[e,l]).
+    
+    Wmatrix_mass, the V matrix of calcDMTransformMatrix and their product are all a permutation combined with 
+    2x2 blocks (k <= 2), so applying them along one index of F is an index remap plus a small update on the 
+    block columns. This costs O(n^4) per index instead of O(n^5) for the dense contraction.
+    """
+    def __init__(self, rows, coeffs, nOld):
+        self.rows   = np.asarray(rows)   # Shape (nNew, k)
+        self.coeffs = np.asarray(coeffs) # Shape (nNew, k)
+        self.shape  = (nOld, self.rows.shape[0])
+    
+    @classmethod
+    def fromDense(cls, V):
+        V = np.asarray(V)
+        nonzero = (V != 0.)
+        k = max(1, int(np.max(np.sum(nonzero, axis=0))))
+        # Stable sort puts the rows with non-zero entries first in every column
+        rows   = np.argsort(~nonzero, axis=0, kind='stable')[:k].T
+        coeffs = np.take_along_axis(V, rows.T, axis=0).T
+        return cls(rows, coeffs, V.shape[0])
+    
+    def toDense(self):
+        V = np.zeros(self.shape, dtype=self.coeffs.dtype)
+        cols = np.broadcast_to(np.arange(self.shape[1])[:,None], self.rows.shape)
+        np.add.at(V, (self.rows, cols), self.coeffs)
+        return V
+    
+    def columns(self, indices):
+        #-- Equivalent of V[:, indices] --#
+        return StructuredTransform(self.rows[indices], self.coeffs[indices], self.shape[0])
+    
+    def __matmul__(self, other):
+        # The product of two such matrices is again sparse, which fromDense picks up (n=91 at most)
+        return StructuredTransform.fromDense(self.toDense() @ other.toDense())
+    
+    def applyAxis(self, F, axis):
+        #-- F_new[..., e, ...] = sum_a V_ae F[..., a, ...] along the given axis --#
+        shape = [1]*F.ndim
+        shape[axis] = -1
+        
+        Fnew = np.take(F, self.rows[:,0], axis=axis)*self.coeffs[:,0].reshape(shape)
+        for l in range(1, self.rows.shape[1]):
+            cols = np.nonzero(self.coeffs[:,l])[0] # Only the columns of the 2x2 blocks
+            if len(cols) == 0:
+                continue
+            index = [slice(None)]*F.ndim
+            index[axis] = cols
+            Fnew[tuple(index)] += np.take(F, self.rows[cols,l], axis=axis)*self.coeffs[cols,l].reshape(shape)
+        
+        return Fnew
+
 #################################################################
 ##
 ## Transform F (or Fhat) Matrices into definite new basis
@@ -24,13 +84,95 @@ def transformF(V, FMatrix_old, DEBUG=True):
         print(path)
         >> ['einsum_path', (0, 4), (0, 3), (0, 2), (0, 1)]
     which we use below.
+    
+    If V is a StructuredTransform it is instead applied to one index at a time with index remaps.
     """   
 
-    path = ['einsum_path', (0, 4), (0, 3), (0, 2), (0, 1)] # Most efficient sum path 
-    FMatrix_new = np.einsum('ae,bf,cg,dh,abcd -> efgh',V,V,V,V,FMatrix_old, optimize=path)
+    if isinstance(V, StructuredTransform):
+        FMatrix_new = FMatrix_old
+        for axis in range(4):
+            FMatrix_new = V.applyAxis(FMatrix_new, axis)
+    else:
+        path = ['einsum_path', (0, 4), (0, 3), (0, 2), (0, 1)] # Most efficient sum path 
+        FMatrix_new = np.einsum('ae,bf,cg,dh,abcd -> efgh',V,V,V,V,FMatrix_old, optimize=path)
 
     if (DEBUG):
         #! Other checks?
         print("")
         
-    return FMatrix_new
\ No newline at end of file
+    return FMatrix_new
+
+#-- Transform the generators X into new basis --#
+def transformXs(V, X, DEBUG=True):
+    """
+    V: Transformation matrix such that a pion (P) old basis is expressed in the new basis as P^{old}_a = V_ab P^{new}_b.
+    X: Generators X_a in the old basis, shape (n, dimMat, dimMat).
+    
+    Every entry of F1Hat and F2Hat is a trace which is linear in each of the four generators, so 
+    transformF(V, FHat) equals FHat evaluated with the rotated generators X'_e = sum_a V_ae X_a. Rotating the 
+    n generators costs O(n^2 dimMat^2) instead of the O(n^5) contraction of the full tensor.
+    """
+    if isinstance(V, StructuredTransform):
+        Xnew = V.applyAxis(np.asarray(X), 0)
+    else:
+        Xnew = np.einsum('ae,aij->eij', V, np.asarray(X))
+    
+    if (DEBUG):
+        print("Transformed generator shape: ", Xnew.shape)
+        print("")
+        
+    return Xnew
+
+#-- Transform only selected index blocks of FMatrix into new basis --#
+def transformFSector(V, FMatrix_old, patterns, sectorIndices, DEBUG=True):
+    """
+    V:             Transformation matrix (dense or StructuredTransform), as in transformF.
+    FMatrix_old:   The tensor F(a,b,c,d) in the old basis.
+    patterns:      List of blocks of the new tensor to return, e.g. ['DDSS', 'SDSD'].
+    sectorIndices: Dictionary from sector label to indices in the new basis, e.g. {'D': DMindexlist, 'S': SMindexlist}.
+    
+    Returns a dictionary from pattern to block, e.g. FBlocks['SDSD'][p,q,r,s] = FMatrix_new[S[p], D[q], S[r], D[s]]
+    with FMatrix_new = transformF(V, FMatrix_old).
+    
+    The indices are contracted one at a time from last to first, only keeping the partial results whose trailing 
+    sectors appear in one of the requested patterns. Columns of V outside every sector (e.g. eta') are never formed.
+    """
+    partial = {'': FMatrix_old}
+    for axis in [3, 2, 1, 0]:
+        newPartial = {}
+        for suffix in list(partial.keys()):
+            F = partial.pop(suffix) # Free each partial result as soon as it has been contracted
+            for label, indices in sectorIndices.items():
+                key = label + suffix
+                if any(pattern.endswith(key) for pattern in patterns):
+                    if isinstance(V, StructuredTransform):
+                        newPartial[key] = V.columns(indices).applyAxis(F, axis)
+                    else:
+                        # tensordot puts the new index last, move it back into place
+                        Fnew = np.tensordot(F, V[:, indices], axes=([axis], [0]))
+                        newPartial[key] = np.moveaxis(Fnew, -1, axis)
+        partial = newPartial
+    
+    FBlocks = {pattern: np.ascontiguousarray(partial[pattern]) for pattern in patterns}
+    
+    if (DEBUG):
+        print("Transformed block shapes: ", [FBlocks[pattern].shape for pattern in patterns])
+        print("")
+    
+    return FBlocks
+
+#-- Transform a single block of F, given the blocks of V connecting its old and new sectors --#
+def transformFBlock(Vblocks, FBlock_old):
+    """
+    Vblocks:    Four matrices, Vblocks[m] = V[np.ix_(oldIndices_m, newIndices_m)] for axis m.
+    FBlock_old: F_old[np.ix_(oldIndices_0, ..., oldIndices_3)], e.g. as read by tensorStore.readTensorBlock.
+    
+    Returns F_new[np.ix_(newIndices_0, ..., newIndices_3)], which equals the corresponding block of 
+    transformF(V, F_old) if V vanishes between the new indices and all old indices outside the block.
+    """
+    F = FBlock_old
+    for Vm in Vblocks:
+        # Contracting the leading index puts the new index last, so after four steps the order is restored
+        F = np.tensordot(F, Vm, axes=([0], [0]))
+    
+    return F